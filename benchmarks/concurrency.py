@@ -0,0 +1,83 @@
+"""Stress check for storage read-modify-write under concurrent handlers.
+
+Fires thousands of adds from several threads, each running many asyncio
+tasks that yield between reading and writing, the way handlers interleave
+on await. Every add stores a listing and bumps a shared listing counter. The old get/mutate/await/set pattern loses updates;
+`storage.update` must not lose any.
+
+Run from the repository root: python -m benchmarks.concurrency [threads] [tasks]
+"""
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Any, Callable, Dict
+import asyncio
+import sys
+
+from storage import JSONStorage, SQLiteStorage, WriteBehindStorage
+
+
+def listing(name: str) -> Dict[str, Any]:
+    return {"name": name, "price": 10.0, "period": 1, "image": "", "category": "transport", "description": name}
+
+
+async def naive_add(storage: Any, name: str) -> None:
+    listings = (storage.get("stats") or {}).get("listings", 0)
+    await asyncio.sleep(0)
+    storage.put("items", [name], listing(name))
+    storage.put("stats", ["listings"], listings + 1)
+
+
+async def update_add(storage: Any, name: str) -> None:
+    await asyncio.sleep(0)
+    with storage.batch():
+        storage.put("items", [name], listing(name))
+        storage.update("stats", ["listings"], lambda listings: (listings or 0) + 1)
+
+
+def run_thread(storage: Any, add: Callable, thread: int, tasks: int) -> None:
+    async def main() -> None:
+        await asyncio.gather(*(add(storage, f"item-{thread}-{task}") for task in range(tasks)))
+    asyncio.run(main())
+
+
+def engines(directory: str) -> Dict[str, Callable[[], Any]]:
+    return {
+        "json": lambda: JSONStorage("stress", directory),
+        "sqlite": lambda: SQLiteStorage(path.join(directory, "stress_data.db")),
+        "write-behind": lambda: WriteBehindStorage(
+            SQLiteStorage(path.join(directory, "behind_data.db")), ["items"],
+            path.join(directory, "behind_journal.jsonl"), durability="none"),
+    }
+
+
+def stress(storage: Any, add: Callable, threads: int, tasks: int) -> int:
+    storage.set("items", {})
+    storage.set("stats", {"listings": 0})
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for future in [executor.submit(run_thread, storage, add, thread, tasks) for thread in range(threads)]:
+            future.result()
+    assert len(storage.get("items")) == threads * tasks, "listings went missing"
+    return storage.get("stats")["listings"]
+
+
+def main(threads: int, tasks: int) -> None:
+    expected = threads * tasks
+    with TemporaryDirectory() as directory:
+        for engine, build in engines(directory).items():
+            storage = build()
+            lost = expected - stress(storage, naive_add, threads, tasks)
+            print(f"{engine:>12} get/await/set: {lost} of {expected} counter updates lost")
+
+            start = perf_counter()
+            count = stress(storage, update_add, threads, tasks)
+            elapsed = perf_counter() - start
+            assert count == expected, f"{engine} update: {expected - count} of {expected} counter updates lost"
+            print(f"{engine:>12} {'update':>13}: all {expected} counter updates kept ({elapsed:.2f}s)")
+
+
+if __name__ == "__main__":
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    tasks = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+    main(threads, tasks)
@@ -0,0 +1,78 @@
+"""Hop latency of DataRequest and SearchRequest round trips: loopback HTTP vs the local bus.
+
+Run from the repository root: python -m benchmarks.local [round_trips]
+"""
+from os import environ, path
+from statistics import median, quantiles
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from uagents import Agent, Context, Protocol  # type: ignore
+from models import DataRequest, Item, Response, SearchRequest, SearchResponse
+from registry import get_registry, port_in_use
+from transport import transport, local_bus
+import asyncio
+import json
+import sys
+
+ITEM = Item(name="bike", price=100.0, period=24, image="", category="transport", description="A city bike")
+
+bench_protocol = Protocol(name="bench_protocol", version="1.0")
+
+
+@bench_protocol.on_query(model=DataRequest, replies={Response})
+async def data(context: Context, sender: str, request: DataRequest):
+    await context.send(destination=sender, message=Response(status=True, content={"items": [ITEM.model_dump()]}))
+
+
+@bench_protocol.on_query(model=SearchRequest, replies={SearchResponse})
+async def search(context: Context, sender: str, request: SearchRequest):
+    await context.send(destination=sender, message=SearchResponse(items=[("owner", ITEM)], response="Found a bike"))
+
+
+async def over_http(address: str, message) -> None:
+    data = await transport.query(address, message, timeout=10.0)
+    json.loads(data.decode_payload())
+
+
+async def measure(label: str, call, address: str, message, round_trips: int) -> None:
+    samples = []
+    for _ in range(round_trips):
+        start = perf_counter()
+        await call(address, message)
+        samples.append((perf_counter() - start) * 1000)
+    p95 = quantiles(samples, n=20)[-1]
+    print(f"{label:<28} median {median(samples):8.3f} ms   p95 {p95:8.3f} ms")
+
+
+async def main(round_trips: int) -> None:
+    port = get_registry().allocate_port()
+    agent = Agent(name="bench_agent", seed="bench_agent_secret", port=port,
+                  endpoint=[f"http://127.0.0.1:{port}/submit"])
+    agent.include(bench_protocol)
+    local_bus.register(agent)
+
+    with get_registry().update() as registry:
+        registry["agents"]["bench_agent"] = {"name": "bench_agent", "port": port, "agent_address": agent.address}
+
+    asyncio.get_running_loop().create_task(agent.run_async())
+    while not port_in_use(port):
+        await asyncio.sleep(0.1)
+
+    async def over_bus(address: str, message) -> None:
+        await local_bus.query(address, message, timeout=10.0)
+
+    for name, message in [
+        ("DataRequest", DataRequest(data=None)),
+        ("SearchRequest", SearchRequest(category="transport", query="any bikes?", history=""))
+    ]:
+        await measure(f"{name} over HTTP", over_http, agent.address, message, round_trips)
+        await measure(f"{name} over local bus", over_bus, agent.address, message, round_trips)
+
+    await transport.close()
+
+
+if __name__ == "__main__":
+    round_trips = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    with TemporaryDirectory() as directory:
+        environ["AGENT_FILE_PATH"] = path.join(directory, "agents.json")
+        asyncio.run(main(round_trips))
@@ -0,0 +1,94 @@
+"""Throughput of the central agent's billing cycle on a local ledger, offline.
+
+Hosts the central agent and a set of payer user agents in one process,
+all on the in-memory ledger, so no faucet or testnet is needed. Seeds
+thousands of due payments between them and runs one `check_payments`
+tick, with and without PAYMENT_BATCHING: every payment is requested from
+its payer over the local bus, sent on the ledger and confirmed against
+the tx's coin_received events. Checks that every payment settled and was
+rescheduled for its next period.
+
+Run from the repository root: python -m benchmarks.payments [payments] [payers] [confirmation_seconds]
+"""
+from os import chdir, environ, getcwd, path
+from tempfile import TemporaryDirectory
+from time import perf_counter, time
+from typing import Any, Dict, List
+import asyncio
+import sys
+
+
+def seed(payers: List[Any], payees: List[Any], count: int, now: float) -> Dict[str, Dict[str, Any]]:
+    from ids import new_id
+
+    payments = {}
+    for i in range(count):
+        payee = payees[i % len(payees)]
+        payments[new_id()] = {
+            "from": payers[i % len(payers)].address,
+            "to": str(payee.wallet.address()),
+            "to_agent": payee.address,
+            "amount": float(1 + i % 7),
+            "repeat": 60,
+            "next_due": now
+        }
+    return payments
+
+
+async def cycle(central_agent: Any, payments: Dict[str, Dict[str, Any]], batching: bool) -> float:
+    import central
+    from scheduler import PaymentMetrics, PaymentScheduler
+
+    central.PAYMENT_BATCHING = batching
+    central.payment_scheduler = PaymentScheduler()
+    central.payment_metrics = PaymentMetrics()
+    context = central_agent._build_context()
+    context.storage.set("payments", payments)
+
+    start = perf_counter()
+    await central.check_payments(context)
+    return perf_counter() - start
+
+
+async def run(central_agent: Any, payers: List[Any], payees: List[Any], count: int) -> None:
+    # Both modes share one event loop, which the local bus is bound to
+    import central
+
+    for batching in (False, True):
+        now = time()
+        elapsed = await cycle(central_agent, seed(payers, payees, count, now), batching)
+
+        stored = central_agent._storage.get("payments")
+        assert central.payment_metrics.settled == count, f"{central.payment_metrics.settled} of {count} payments settled"
+        assert all(payment["next_due"] >= now + 60 for payment in stored.values()), "a payment was not rescheduled"
+        mode = "batched" if batching else "one tx each"
+        print(f"{mode:>12}: {count} payments from {len(payers)} payers settled in {elapsed:.2f}s "
+              f"({count / elapsed * 60:,.0f} payments/minute)")
+
+
+def main(count: int, payer_count: int, latency: float) -> None:
+    cwd = getcwd()
+    with TemporaryDirectory() as directory:
+        # Agent stores are created in the working directory
+        chdir(directory)
+        environ["AGENT_FILE_PATH"] = path.join(directory, "agents.json")
+        environ["PAYMENT_LOG_PATH"] = path.join(directory, "payment_log")
+        environ["LEDGER_BACKEND"] = "memory"
+        environ["LEDGER_CONFIRMATION_LATENCY"] = str(latency)
+        environ["ID_NODE"] = "1"
+        try:
+            from central import central_agent
+            from user import create_user_agent
+
+            payers = [create_user_agent(f"payer-{i}", central_agent.address) for i in range(payer_count)]
+            payees = [create_user_agent(f"payee-{i}", central_agent.address) for i in range(10)]
+            asyncio.run(run(central_agent, payers, payees, count))
+        finally:
+            chdir(cwd)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    payer_count = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.5
+    main(count, payer_count, latency)
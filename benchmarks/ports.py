@@ -0,0 +1,44 @@
+"""Stress check for the port allocator: concurrent AgentData launches get unique ports.
+
+Run from the repository root: python -m benchmarks.ports [agents] [processes]
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from os import environ, path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import sys
+
+
+def launch(names):
+    from utils import AgentData
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        return list(executor.map(lambda name: AgentData(name=name).port, names))
+
+
+def main(agents: int, processes: int) -> None:
+    with TemporaryDirectory() as directory:
+        environ["AGENT_FILE_PATH"] = path.join(directory, "agents.json")
+
+        names = [f"stress_{i}" for i in range(agents)]
+        chunks = [names[i::processes] for i in range(processes)]
+
+        start = perf_counter()
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            ports = [port for chunk in executor.map(launch, chunks) for port in chunk]
+        elapsed = perf_counter() - start
+
+        from registry import get_registry
+        active = [int(port) for port in get_registry().read()["config"]["leases"]]
+
+        assert len(ports) == agents, f"expected {agents} ports, got {len(ports)}"
+        assert len(set(ports)) == agents, "duplicate ports were allocated"
+        assert sorted(active) == sorted(ports), "registry leases are out of sync"
+
+        print(f"{agents} agents across {processes} processes: all ports unique ({elapsed:.2f}s)")
+
+
+if __name__ == "__main__":
+    agents = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    main(agents, processes)
@@ -0,0 +1,95 @@
+"""Handler-path cost of a user's rental state as their listings grow.
+
+Compares the old list scans (`for item in items` + `list.remove`) with the
+indexed RentalState for a rent, hand-over and return cycle on one item.
+Storage is kept in memory, so only the handler work is measured.
+
+Run from the repository root: python -m benchmarks.rentals [sizes...]
+"""
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any, Dict, Iterator, List
+import sys
+
+from rentals import RentalState
+
+
+class MemoryStorage:
+    def __init__(self) -> None:
+        self.data: Dict[str, Any] = {}
+
+    def has(self, key: str) -> bool:
+        return key in self.data
+
+    def get(self, key: str) -> Any:
+        return self.data.get(key)
+
+    def set(self, key: str, value: Any) -> None:
+        self.data[key] = value
+
+    def put(self, key: str, keys: List[str], value: Any) -> None:
+        root = self.data.setdefault(key, {})
+        for part in keys[:-1]:
+            root = root.setdefault(part, {})
+        root[keys[-1]] = value
+
+    def delete(self, key: str, keys: List[str]) -> Any:
+        root = self.data.get(key, {})
+        for part in keys[:-1]:
+            root = root.get(part, {})
+        return root.pop(keys[-1], None)
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        yield
+
+
+def listing(i: int) -> Dict[str, Any]:
+    return {"name": f"item-{i}", "price": 10.0, "period": 1, "image": "x" * 2048,
+            "category": "other", "description": f"listing {i}"}
+
+
+def list_cycle(state: Dict[str, list], name: str) -> None:
+    item = next(item for item in state["items"] if item["name"] == name)
+    state["items"].remove(item)
+    state["handover"].append((item, "agent"))
+    entry = next(entry for entry in state["handover"] if entry[0]["name"] == name)
+    state["handover"].remove(entry)
+    state["rented"].append((entry[0], "1234"))
+    entry = next(entry for entry in state["rented"] if entry[0]["name"] == name)
+    state["rented"].remove(entry)
+    state["items"].append(entry[0])
+
+
+def indexed_cycle(rentals: RentalState, name: str) -> None:
+    rentals.move("items", "handover", name, lambda item: (item, "agent"))
+    rentals.move("handover", "rented", name, lambda entry: (entry[0], "1234"))
+    rentals.move("rented", "items", name, lambda entry: entry[0])
+
+
+def main(sizes) -> None:
+    for size in sizes:
+        items = [listing(i) for i in range(size)]
+        # The target sits mid-catalog, so scans do half the work on average
+        name = f"item-{size // 2}"
+        rounds = 200
+
+        state = {"items": list(items), "handover": [], "rented": []}
+        start = perf_counter()
+        for _ in range(rounds):
+            list_cycle(state, name)
+        scan = (perf_counter() - start) / rounds
+
+        storage = MemoryStorage()
+        storage.set("items", list(items))
+        rentals = RentalState(storage)
+        start = perf_counter()
+        for _ in range(rounds):
+            indexed_cycle(rentals, name)
+        indexed = (perf_counter() - start) / rounds
+
+        print(f"{size:>6} listings: list scans {scan * 1e6:9.1f}us/cycle, indexed {indexed * 1e6:6.1f}us/cycle")
+
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or [100, 1000, 10000])
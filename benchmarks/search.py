@@ -0,0 +1,119 @@
+"""Prompt size and retrieval latency of city search as the catalog grows.
+
+Loads a synthetic category into a CityCatalog with its BM25 index attached,
+then compares the listings a search puts into the LLM prompt with and
+without the top-k prefilter. Prompt tokens are estimated at four
+characters per token of the listing data city.create_data sends; the LLM
+call itself is not made. Also times the index upkeep on add and delete,
+and the same searches answered by the TF-IDF vector index
+(SEARCH_MODE=vector), singly and in batches.
+
+Run from the repository root: python -m benchmarks.search [sizes...]
+"""
+from random import Random
+from statistics import quantiles
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Any, Dict, List
+import json
+import sys
+
+from catalog import CityCatalog
+from search import SEARCH_TOP_K, CatalogSearch, VectorIndex
+
+NOUNS = ["bike", "scooter", "car", "van", "helmet", "jacket", "camera", "drone", "laptop", "tent",
+         "kayak", "projector", "speaker", "guitar", "drill", "ladder", "sofa", "desk", "chair", "lamp"]
+ADJECTIVES = ["electric", "vintage", "compact", "waterproof", "portable", "heavy", "folding", "leather",
+              "wireless", "mountain", "city", "kids", "professional", "lightweight", "large", "small"]
+QUERIES = ["electric bike for the weekend", "waterproof jacket", "portable speaker for a party",
+           "folding chair", "camera with lens", "something to carry a sofa", "kids helmet", "what can I rent?"]
+SEARCHES = 200
+BATCH = 32
+
+
+def listing(random: Random, i: int) -> Dict[str, Any]:
+    noun = random.choice(NOUNS)
+    words = random.sample(ADJECTIVES, 3) + random.sample(NOUNS, 2)
+    return {"name": f"{random.choice(ADJECTIVES)} {noun} {i}", "price": 10.0, "period": 24, "image": "",
+            "category": "transport", "description": f"A {' '.join(words)} {noun} in good condition"}
+
+
+def prompt_tokens(listings: Dict[str, Dict[str, Any]]) -> int:
+    data = [{"user_id": owner, "name": name, "price": f"{item['price']}/day", "description": item["description"]}
+            for owner, items in listings.items() for name, item in items.items()]
+    return len(json.dumps(data)) // 4
+
+
+def p95(samples: List[float]) -> float:
+    return quantiles(samples, n=20)[-1] * 1000
+
+
+def vector_search(size: int) -> None:
+    random = Random(7)
+    with TemporaryDirectory() as directory:
+        catalog = CityCatalog(directory, "vectors", snapshot_every=10 ** 9)
+        search = CatalogSearch(catalog, VectorIndex)
+        adds = []
+        for i in range(size):
+            item = listing(random, i)
+            start = perf_counter()
+            catalog.add("transport", f"owner-{i % 500}", item)
+            adds.append(perf_counter() - start)
+
+        latencies = []
+        for i in range(SEARCHES):
+            start = perf_counter()
+            search.ranked("transport", QUERIES[i % len(QUERIES)])
+            latencies.append(perf_counter() - start)
+
+        index = search.indexes["transport"]
+        batch = [QUERIES[i % len(QUERIES)] for i in range(BATCH)]
+        start = perf_counter()
+        for _ in range(SEARCHES // BATCH):
+            index.top_k_batch(batch, SEARCH_TOP_K)
+        batched = (perf_counter() - start) / (SEARCHES // BATCH * BATCH)
+
+        assert "bike" in search.ranked("transport", "electrik bike")[0][1]["name"], "typo missed the bikes"
+        catalog.close()
+
+    print(f"{size:>7} listings: vector p95 {p95(latencies):7.2f}ms per search, {batched * 1000:.2f}ms per search "
+          f"in batches of {BATCH}; add p95 {p95(adds):.3f}ms")
+
+
+def main(sizes: List[int]) -> None:
+    random = Random(7)
+    for size in sizes:
+        with TemporaryDirectory() as directory:
+            catalog = CityCatalog(directory, "bench", snapshot_every=10 ** 9)
+            search = CatalogSearch(catalog)
+
+            adds, added = [], []
+            for i in range(size):
+                item = listing(random, i)
+                start = perf_counter()
+                catalog.add("transport", f"owner-{i % 500}", item)
+                adds.append(perf_counter() - start)
+                added.append((f"owner-{i % 500}", item["name"]))
+
+            full = prompt_tokens(catalog.category("transport"))
+            tokens, latencies = [], []
+            for i in range(SEARCHES):
+                start = perf_counter()
+                candidates = search.candidates("transport", QUERIES[i % len(QUERIES)])
+                latencies.append(perf_counter() - start)
+                tokens.append(prompt_tokens(candidates))
+
+            deletes = []
+            for owner, name in added[::max(1, size // 200)]:
+                start = perf_counter()
+                catalog.delete("transport", owner, name)
+                deletes.append(perf_counter() - start)
+            catalog.close()
+
+        print(f"{size:>7} listings: prompt ~{full:>9} tokens unfiltered, ~{max(tokens):>5} with top-{SEARCH_TOP_K}; "
+              f"retrieval p95 {p95(latencies):7.2f}ms; add p95 {p95(adds):.3f}ms, delete p95 {p95(deletes):.3f}ms")
+        vector_search(size)
+
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or [1000, 10000, 100000])
@@ -0,0 +1,172 @@
+"""Add and delete latency of a city agent while LLM searches are in flight.
+
+Builds a real city agent whose chain is swapped for a stand-in that
+answers after a fixed delay, the way the Gemini round trip does, and
+drives it the way uagents' HTTP server does: every request registers a
+reply future and goes onto the agent's message queue, which runs one
+handler at a time. Searches are sent together with a steady stream of
+AddRequest and DeleteRequest queries; each one's latency runs from
+enqueueing to its reply. Also checks the concurrency limit, that
+identical searches sent at once share one LLM call, and the deadline.
+
+Run from the repository root: python -m benchmarks.searchloop [searches] [llm_seconds]
+"""
+from os import environ, path
+from random import Random
+from statistics import quantiles
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Any, Dict, List, Tuple
+from uuid import uuid4
+import asyncio
+import json
+import sys
+
+MESSAGE_INTERVAL = 0.005
+
+
+class SlowChain:
+    """Answers like the search chain after `latency` seconds."""
+
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.calls = 0
+        self.running = 0
+        self.peak = 0
+
+    async def ainvoke(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        self.calls += 1
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.running -= 1
+        return {"response": "", "items": []}
+
+
+def p95(samples: List[float]) -> float:
+    return quantiles(samples, n=20)[-1] * 1000
+
+
+async def query(agent: Any, message: Any, timeout: float = 60.0) -> Dict[str, Any]:
+    """Delivers `message` to `agent` as a sync query and returns the reply payload."""
+    from uagents import Model  # type: ignore
+    from uagents.crypto import generate_user_address  # type: ignore
+
+    sender = generate_user_address()
+    reply = asyncio.get_running_loop().create_future()
+    agent._queries[sender] = reply
+    try:
+        await agent.handle_message(sender, Model.build_schema_digest(message), message.model_dump_json(), uuid4())
+        body, _ = await asyncio.wait_for(reply, timeout)
+        return json.loads(body)
+    finally:
+        agent._queries.pop(sender, None)
+
+
+async def run(agent: Any, searches: int, latency: float) -> List[float]:
+    from benchmarks.search import listing
+    from city import chains
+    from models import AddRequest, DeleteRequest, Item, SearchRequest
+    from search import SEARCH_CONCURRENCY
+
+    chain = chains[agent.address] = SlowChain(latency)
+    random = Random(3)
+    latencies: List[float] = []
+    done = asyncio.Event()
+
+    async def edits() -> None:
+        i = 0
+        while not done.is_set():
+            item = Item(**listing(random, i))
+            start = perf_counter()
+            await query(agent, AddRequest(item=item, agent_address="owner"))
+            await query(agent, DeleteRequest(name=item.name, category=item.category, agent_address="owner"))
+            latencies.append((perf_counter() - start) / 2)
+            i += 1
+            await asyncio.sleep(MESSAGE_INTERVAL)
+
+    async def searching() -> None:
+        await asyncio.gather(*(
+            query(agent, SearchRequest(category="transport", query=f"electric bike {i}", history=""))
+            for i in range(searches)))
+        done.set()
+
+    await asyncio.gather(edits(), searching())
+
+    assert chain.calls == searches, f"{chain.calls} of {searches} searches reached the chain"
+    assert chain.peak <= SEARCH_CONCURRENCY, f"{chain.peak} calls ran at once, limit is {SEARCH_CONCURRENCY}"
+    return latencies
+
+
+async def coalescing(agent: Any, copies: int, latency: float) -> int:
+    """Sends `copies` identical searches at once; returns how many joined the first one's LLM call."""
+    from city import chains, search_flights
+    from models import SearchRequest
+
+    chain = chains[agent.address] = SlowChain(latency)
+    flights = search_flights[agent.address]
+    shared = flights.shared
+    request = SearchRequest(category="transport", query="folding kayak for two", history="")
+    replies = await asyncio.gather(*(query(agent, request) for _ in range(copies)))
+
+    assert chain.calls == 1, f"{copies} identical searches made {chain.calls} LLM calls"
+    assert all(reply == replies[0] for reply in replies), "identical searches got different answers"
+    return flights.shared - shared
+
+
+async def serve(agent: Any, searches: int, latency: float, copies: int) -> Tuple[List[float], float, int]:
+    """Runs the agent's message queue while the load and the coalescing check are sent to it."""
+    processing = asyncio.ensure_future(agent._process_message_queue())
+    start = perf_counter()
+    latencies = await run(agent, searches, latency)
+    elapsed = perf_counter() - start
+    joined = await coalescing(agent, copies, latency)
+    processing.cancel()
+    return latencies, elapsed, joined
+
+
+async def deadline(latency: float) -> None:
+    from search import invoke_chain
+
+    try:
+        await invoke_chain(SlowChain(latency), {}, asyncio.Semaphore(1), timeout=latency / 10)
+    except asyncio.TimeoutError:
+        return
+    raise AssertionError("deadline was not enforced")
+
+
+def main(searches: int, latency: float) -> None:
+    with TemporaryDirectory() as directory:
+        environ["AGENT_FILE_PATH"] = path.join(directory, "agents.json")
+        environ["CATALOG_PATH"] = path.join(directory, "catalogs")
+        environ["FAST_BOOT"] = "1"
+        environ["LEDGER_BACKEND"] = "memory"
+        environ["SEARCH_MODE"] = "llm"
+        # The chain is replaced before any search, so the Gemini client is never called
+        environ.setdefault("GOOGLE_API_KEY", "unused")
+        from benchmarks.search import listing
+        from city import catalogs, create_city_agent
+        from search import SEARCH_CONCURRENCY
+
+        agent = create_city_agent("searchloop", "central", port=0)
+        random = Random(7)
+        for i in range(5000):
+            catalogs[agent.address].add("transport", f"owner-{i % 50}", listing(random, i))
+
+        copies = 8
+        latencies, elapsed, joined = asyncio.run(serve(agent, searches, latency, copies))
+        print(f"{searches} searches of {latency * 1000:.0f}ms in {elapsed:.2f}s, {len(latencies)} adds+deletes "
+              f"meanwhile: p95 {p95(latencies):.2f}ms, max {max(latencies) * 1000:.2f}ms per message")
+        print(f"{copies} identical searches sent at once: 1 LLM call, {joined} joined it")
+        catalogs[agent.address].close()
+
+    asyncio.run(deadline(latency))
+    print(f"deadline enforced; at most {SEARCH_CONCURRENCY} LLM calls ran at once")
+
+
+if __name__ == "__main__":
+    searches = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.25
+    main(searches, latency)
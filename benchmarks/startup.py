@@ -0,0 +1,40 @@
+"""Time to create 1, 10 and 100 agents with and without fast boot.
+
+Run from the repository root: python -m benchmarks.startup [--with-funding]
+
+Without --with-funding only fast boot is measured, since the regular path
+needs the testnet faucet and ledger to be reachable.
+"""
+from os import environ, path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import sys
+
+
+def boot(count: int, fast_boot: bool) -> float:
+    from registry import get_registry
+    from utils import create_agent, get_port
+
+    port = get_port()
+    start = perf_counter()
+    for i in range(count):
+        create_agent(f"startup_{fast_boot}_{count}_{i}", port=port, fast_boot=fast_boot)
+    get_registry().flush()
+    return perf_counter() - start
+
+
+def main(with_funding: bool) -> None:
+    with TemporaryDirectory() as directory:
+        environ["AGENT_FILE_PATH"] = path.join(directory, "agents.json")
+
+        for count in (1, 10, 100):
+            fast = boot(count, fast_boot=True)
+            line = f"{count:>4} agents  fast boot {fast:8.3f}s ({fast / count * 1000:7.2f} ms/agent)"
+            if with_funding:
+                regular = boot(count, fast_boot=False)
+                line += f"  regular {regular:8.3f}s ({regular / count * 1000:7.2f} ms/agent)"
+            print(line)
+
+
+if __name__ == "__main__":
+    main("--with-funding" in sys.argv)
@@ -0,0 +1,69 @@
+"""Write throughput of agent storage engines as a city's catalog grows.
+
+Each write adds one listing (with a 2 KB image) the way city.add_item does:
+the JSON store rewrites the whole file, the SQLite store only the listing's
+rows. Also checks that a JSON storage file migrates into SQLite intact.
+
+Run from the repository root: python -m benchmarks.storage [sizes...]
+"""
+from os import path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Any, Dict
+import json
+import sys
+
+from storage import JSONStorage, SQLiteStorage
+
+CATEGORIES = ["wearable", "transport", "electronic", "furniture"]
+WRITES = 200
+
+
+def listing(i: int) -> Dict[str, Any]:
+    return {"name": f"item-{i}", "price": 10.0, "period": 1, "image": "x" * 2048,
+            "category": CATEGORIES[i % len(CATEGORIES)], "description": f"listing {i}"}
+
+
+def catalog(size: int) -> Dict[str, Any]:
+    items: Dict[str, Any] = {category: {} for category in CATEGORIES}
+    for i in range(size):
+        item = listing(i)
+        items[item["category"]].setdefault(f"owner-{i % 50}", {})[item["name"]] = item
+    return items
+
+
+def writes_per_second(storage: Any, size: int) -> float:
+    start = perf_counter()
+    for i in range(size, size + WRITES):
+        item = listing(i)
+        storage.put("items", [item["category"], f"owner-{i % 50}", item["name"]], item)
+    return WRITES / (perf_counter() - start)
+
+
+def main(sizes) -> None:
+    for size in sizes:
+        with TemporaryDirectory() as directory:
+            json_storage = JSONStorage("bench", directory)
+            json_storage.set("items", catalog(size))
+            json_rate = writes_per_second(json_storage, size)
+
+            sqlite_storage = SQLiteStorage(path.join(directory, "bench_data.db"))
+            sqlite_storage.set("items", catalog(size))
+            sqlite_rate = writes_per_second(sqlite_storage, size)
+
+            print(f"{size:>6} listings: json {json_rate:8.1f} writes/s, sqlite {sqlite_rate:8.1f} writes/s")
+
+    with TemporaryDirectory() as directory:
+        legacy_path = path.join(directory, "legacy_data.json")
+        with open(legacy_path, 'w') as file:
+            json.dump({"users": {"1": "agent"}, "items": catalog(100)}, file)
+        migrated = SQLiteStorage(path.join(directory, "legacy_data.db"), legacy_path)
+        reopened = SQLiteStorage(path.join(directory, "legacy_data.db"))
+        assert migrated.get("items") == reopened.get("items") == catalog(100), "migration lost data"
+        assert reopened.get("users") == {"1": "agent"}, "migration lost data"
+        assert not path.exists(legacy_path), "legacy file was not moved aside"
+        print("JSON storage migrated to SQLite intact")
+
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or [100, 1000, 10000])
@@ -0,0 +1,73 @@
+"""Messages per second through the shared transport, with and without pooling.
+
+Run from the repository root: python -m benchmarks.transport [messages] [concurrency]
+"""
+from time import perf_counter, time
+from uuid import uuid4
+from aiohttp import web
+from uagents import Model  # type: ignore
+from uagents.crypto import generate_user_address  # type: ignore
+from uagents.envelope import Envelope  # type: ignore
+from transport import Transport
+import asyncio
+import sys
+
+
+class Ping(Model):
+    data: str
+
+
+async def submit(request: web.Request) -> web.Response:
+    await request.read()
+    return web.json_response({})
+
+
+async def run(transport: Transport, endpoint: str, messages: int, concurrency: int) -> float:
+    envelope = Envelope(
+        version=1,
+        sender=generate_user_address(),
+        target="agent",
+        session=uuid4(),
+        schema_digest=Model.build_schema_digest(Ping),
+        protocol_digest=None,
+        expires=int(time()) + 60
+    )
+    envelope.encode_payload(Ping(data="ping").model_dump_json())
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send() -> None:
+        async with semaphore:
+            await transport.send_exchange_envelope(envelope, [endpoint])
+
+    start = perf_counter()
+    await asyncio.gather(*(send() for _ in range(messages)))
+    elapsed = perf_counter() - start
+    await transport.close()
+    return messages / elapsed
+
+
+async def main(messages: int, concurrency: int) -> None:
+    app = web.Application()
+    app.router.add_post("/submit", submit)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]  # type: ignore
+    endpoint = f"http://127.0.0.1:{port}/submit"
+
+    unpooled = await run(Transport(pooled=False), endpoint, messages, concurrency)
+    pooled = await run(Transport(pool_size=concurrency), endpoint, messages, concurrency)
+
+    print(f"messages={messages} concurrency={concurrency}")
+    print(f"without pooling: {unpooled:10.1f} msg/s")
+    print(f"with pooling:    {pooled:10.1f} msg/s ({pooled / unpooled:.2f}x)")
+
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    asyncio.run(main(messages, concurrency))
@@ -0,0 +1,84 @@
+"""Write-behind storage: burst throughput and crash recovery.
+
+Times a burst of single-item adds against the plain engine and the
+write-behind cache, then kills a writer process mid-burst, before any
+flush, and checks which writes each durability level brings back.
+
+Run from the repository root: python -m benchmarks.writebehind [writes] [backend]
+"""
+from multiprocessing import get_context
+from os import _exit, path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Any, Dict
+import sys
+
+from storage import JSONStorage, SQLiteStorage, WriteBehindStorage
+
+CATEGORIES = ["wearable", "transport", "electronic", "furniture"]
+
+
+def listing(i: int) -> Dict[str, Any]:
+    return {"name": f"item-{i}", "price": 10.0, "period": 1, "image": "x" * 2048,
+            "category": CATEGORIES[i % len(CATEGORIES)], "description": f"listing {i}"}
+
+
+def engine(directory: str, backend: str) -> Any:
+    if backend == "sqlite":
+        return SQLiteStorage(path.join(directory, "bench_data.db"))
+    return JSONStorage("bench", directory)
+
+
+def cached(directory: str, backend: str, durability: str) -> WriteBehindStorage:
+    # Thresholds high enough that nothing is flushed during the burst
+    return WriteBehindStorage(engine(directory, backend), ["items"], path.join(directory, "bench_journal.jsonl"),
+                              max_pending=10 ** 9, max_delay=10 ** 9, durability=durability)
+
+
+def burst(storage: Any, writes: int) -> float:
+    start = perf_counter()
+    for i in range(writes):
+        item = listing(i)
+        storage.put("items", [item["category"], "owner", item["name"]], item)
+    return writes / (perf_counter() - start)
+
+
+def crash(directory: str, backend: str, durability: str, writes: int) -> None:
+    burst(cached(directory, backend, durability), writes)
+    # Die without flushing or running any shutdown handler
+    _exit(9)
+
+
+def recovered(writes: int, backend: str, durability: str) -> int:
+    with TemporaryDirectory() as directory:
+        process = get_context("spawn").Process(target=crash, args=(directory, backend, durability, writes))
+        process.start()
+        process.join()
+        assert process.exitcode == 9, f"writer exited with {process.exitcode}"
+
+        items = cached(directory, backend, durability).get("items") or {}
+        return sum(len(owners.get("owner", {})) for owners in items.values())
+
+
+def main(writes: int, backend: str) -> None:
+    with TemporaryDirectory() as directory:
+        direct = burst(engine(directory, backend), writes)
+    for durability in ("none", "journal", "fsync"):
+        with TemporaryDirectory() as directory:
+            storage = cached(directory, backend, durability)
+            rate = burst(storage, writes)
+            start = perf_counter()
+            storage.close()
+            flush = perf_counter() - start
+        print(f"{backend} {durability:>7}: {rate:9.1f} writes/s (direct {direct:.1f}), final flush {flush * 1000:.1f}ms")
+
+    for durability, expected in (("none", 0), ("journal", writes), ("fsync", writes)):
+        count = recovered(writes, backend, durability)
+        assert count == expected, f"{durability}: recovered {count} of {writes} writes, expected {expected}"
+        print(f"crash with durability={durability}: {count}/{writes} writes recovered")
+
+
+if __name__ == "__main__":
+    writes = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    backend = sys.argv[2] if len(sys.argv) > 2 else "sqlite"
+    main(writes, backend)
@@ -0,0 +1,71 @@
+from json import load
+from os import getenv
+from typing import Any, Dict, List, Optional, Union
+from dotenv import load_dotenv
+from uagents import Bureau  # type: ignore
+from utils import get_agents, get_port, AgentData
+from registry import get_registry
+from city import create_city_agent
+from user import create_user_agent
+import sys
+
+load_dotenv()
+
+# Users are given by code, or as {"code": ..., "userinfo": {...}} to skip the interactive sign-up
+UserEntry = Union[str, Dict[str, Any]]
+
+
+def user_code(user: UserEntry) -> str:
+    return user if isinstance(user, str) else user["code"]
+
+
+def load_config(file_path: str) -> Dict[str, Any]:
+    with open(file_path, 'r') as file:
+        config = load(file)
+    config.setdefault("cities", [])
+    config.setdefault("users", [])
+    return config
+
+
+def create_bureau(
+    cities: List[str],
+    users: List[UserEntry],
+    central_agent_address: str,
+    port: Optional[int] = None
+) -> Bureau:
+    """Hosts the given city and user agents in one process behind a single Bureau server."""
+    port = port or get_port()
+    bureau = Bureau(port=port, endpoint=[f"http://127.0.0.1:{port}/submit"])
+
+    for city in cities:
+        print(f"Adding city {city} to bureau...")
+        bureau.add(create_city_agent(city, central_agent_address, port=port))
+
+    for user in users:
+        print(f"Adding user {user_code(user)} to bureau...")
+        userinfo = None if isinstance(user, str) else user.get("userinfo")
+        bureau.add(create_user_agent(user_code(user), central_agent_address, port=port, userinfo=userinfo))
+
+    get_registry().flush()
+
+    return bureau
+
+
+if __name__ == "__main__":
+    config_path = sys.argv[1] if len(sys.argv) > 1 else getenv("BUREAU_FILE_PATH")
+
+    if not config_path:
+        print("Usage: python bureau.py <config.json> (or set `BUREAU_FILE_PATH`)")
+        exit(1)
+
+    config = load_config(config_path)
+    central_agent_data: AgentData = get_agents("central_agent")
+
+    if not central_agent_data.agent_address:
+        print("Central agent not found. Exiting...")
+        exit(1)
+
+    bureau = create_bureau(
+        config["cities"], config["users"], central_agent_data.agent_address, port=config.get("port"))
+    print(f"Starting Bureau with {len(config['cities'])} cities and {len(config['users'])} users...")
+    bureau.run()
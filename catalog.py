@@ -0,0 +1,205 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from os import fsync, getenv, makedirs, path, remove, replace
+from shutil import copyfileobj
+from threading import RLock
+from typing import Any, Dict, Iterable, List, Optional
+from dotenv import load_dotenv
+from env import env_flag
+import json
+
+load_dotenv()
+
+CATALOG_PATH = getenv("CATALOG_PATH", "catalogs")
+# Write-ahead log entries replayed on startup at most before a fresh snapshot is taken
+CATALOG_SNAPSHOT_EVERY = int(getenv("CATALOG_SNAPSHOT_EVERY", 1000))
+CATALOG_FSYNC = env_flag("CATALOG_FSYNC")
+
+
+class CityCatalog:
+    """A city's listings, `items[category][owner][name]`, persisted as snapshot plus write-ahead log.
+
+    Every add and delete is appended to the log before it is applied, and
+    every `snapshot_every` operations the whole catalog is written to the
+    snapshot and the log is truncated. A restart loads the snapshot and
+    replays the short log tail, so recovery time does not grow with the
+    catalog's history.
+
+    Snapshots taken while serving are written by a background thread from a
+    copy of the listings, so adds and deletes never wait on the JSON dump
+    or fsync. The log is rotated when the copy is taken and the rotated
+    part is removed once the snapshot is in place.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        name: str,
+        snapshot_every: int = CATALOG_SNAPSHOT_EVERY,
+        durable: bool = CATALOG_FSYNC
+    ) -> None:
+        makedirs(directory, exist_ok=True)
+        self.snapshot_path = path.join(directory, f"{name}.snapshot.json")
+        self.wal_path = path.join(directory, f"{name}.wal")
+        self.rotated_wal_path = f"{self.wal_path}.old"
+        self.snapshot_every = snapshot_every
+        self.durable = durable
+        self.lock = RLock()
+        self.items: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        # Indexes told about every add and delete after recovery, see search.CatalogSearch
+        self.observers: List[Any] = []
+        # Bumped on every change to a category, so answers computed from an older state can be told apart
+        self.versions: Dict[str, int] = {}
+        self.seq = 0
+        self.logged = 0
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"catalog-{name}")
+        self.pending: Optional[Future] = None
+        self.recover()
+        self.wal = open(self.wal_path, 'a')
+
+    def recover(self) -> None:
+        if path.isfile(self.snapshot_path):
+            with open(self.snapshot_path, 'r') as file:
+                snapshot = json.load(file)
+            self.items = snapshot["items"]
+            self.seq = snapshot["seq"]
+
+        # A rotated log left by a crash mid-snapshot holds the entries older than the current one
+        for wal_path in (self.rotated_wal_path, self.wal_path):
+            if path.isfile(wal_path):
+                self.replay(wal_path)
+
+    def replay(self, wal_path: str) -> None:
+        with open(wal_path, 'rb+') as file:
+            offset = 0
+            for line in file:
+                if not line.endswith(b"\n"):
+                    # Drop an entry torn by a crash mid-write
+                    file.truncate(offset)
+                    break
+                offset += len(line)
+                entry = json.loads(line)
+                # Entries already in the snapshot remain if the crash hit between snapshot and truncate
+                if entry[1] > self.seq:
+                    self.apply(entry)
+                    self.logged += 1
+
+    def apply(self, entry: List[Any]) -> None:
+        op, seq, category, owner, name = entry[:5]
+        if op == "add":
+            self.items.setdefault(category, {}).setdefault(owner, {})[name] = entry[5]
+            for observer in self.observers:
+                observer.added(category, owner, entry[5])
+        else:
+            self.items.get(category, {}).get(owner, {}).pop(name, None)
+            for observer in self.observers:
+                observer.deleted(category, owner, name)
+        self.versions[category] = self.versions.get(category, 0) + 1
+        self.seq = seq
+
+    def log(self, entry: List[Any]) -> None:
+        self.wal.write(json.dumps(entry) + "\n")
+        self.wal.flush()
+        if self.durable:
+            fsync(self.wal.fileno())
+        self.apply(entry)
+        self.logged += 1
+        if self.logged >= self.snapshot_every:
+            self.snapshot_in_background()
+
+    def add(self, category: str, owner: str, item: Dict[str, Any]) -> None:
+        with self.lock:
+            self.log(["add", self.seq + 1, category, owner, item["name"], item])
+
+    def delete(self, category: str, owner: str, name: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            item = self.get(category, owner, name)
+            if item is not None:
+                self.log(["delete", self.seq + 1, category, owner, name])
+            return item
+
+    def get(self, category: str, owner: str, name: str) -> Optional[Dict[str, Any]]:
+        return self.items.get(category, {}).get(owner, {}).get(name)
+
+    def category(self, category: str) -> Dict[str, Dict[str, Any]]:
+        return self.items.get(category, {})
+
+    def version(self, category: str) -> int:
+        return self.versions.get(category, 0)
+
+    def ensure_categories(self, categories: Iterable[str]) -> None:
+        """Adds missing categories without touching existing listings."""
+        with self.lock:
+            missing = [category for category in categories if category not in self.items]
+            for category in missing:
+                self.items[category] = {}
+            if missing:
+                self.snapshot_in_background()
+
+    def load(self, items: Dict[str, Dict[str, Dict[str, Any]]]) -> None:
+        """Imports a catalog kept in agent storage before the catalog had its own files."""
+        with self.lock:
+            for category, owners in items.items():
+                for owner, listings in owners.items():
+                    for item in listings.values():
+                        self.items.setdefault(category, {}).setdefault(owner, {})[item["name"]] = item
+                        for observer in self.observers:
+                            observer.added(category, owner, item)
+                self.versions[category] = self.versions.get(category, 0) + 1
+            self.snapshot()
+
+    def rotate(self) -> Dict[str, Any]:
+        """Starts a new log and returns a copy of the state the rotated one leads up to."""
+        self.wal.close()
+        if path.isfile(self.rotated_wal_path):
+            # The last snapshot failed, so the rotated log still holds entries no snapshot has
+            with open(self.wal_path, 'rb') as source, open(self.rotated_wal_path, 'ab') as target:
+                copyfileobj(source, target)
+                target.flush()
+                fsync(target.fileno())
+            remove(self.wal_path)
+        else:
+            replace(self.wal_path, self.rotated_wal_path)
+        self.wal = open(self.wal_path, 'a')
+        self.logged = 0
+        # Listings are replaced, never changed in place, so copying the dicts holding them is enough
+        items = {category: {owner: dict(listings) for owner, listings in owners.items()}
+                 for category, owners in self.items.items()}
+        return {"seq": self.seq, "items": items}
+
+    def write_snapshot(self, state: Dict[str, Any]) -> None:
+        temp_path = f"{self.snapshot_path}.tmp"
+        with open(temp_path, 'w') as file:
+            json.dump(state, file)
+            file.flush()
+            fsync(file.fileno())
+        replace(temp_path, self.snapshot_path)
+        remove(self.rotated_wal_path)
+
+    def snapshot_in_background(self) -> None:
+        with self.lock:
+            # One snapshot at a time; the log keeps growing until the next one starts
+            if self.pending is not None and not self.pending.done():
+                return
+            self.pending = self.writer.submit(self.write_snapshot, self.rotate())
+
+    def wait_for_snapshot(self) -> None:
+        # A failed write leaves its rotated log in place for the next snapshot to cover
+        if self.pending is not None:
+            self.pending.exception()
+            self.pending = None
+
+    def snapshot(self) -> None:
+        """Writes a snapshot before returning, for startup and shutdown."""
+        with self.lock:
+            self.wait_for_snapshot()
+            self.write_snapshot(self.rotate())
+
+    def close(self) -> None:
+        with self.lock:
+            self.snapshot()
+            self.wal.close()
+            self.writer.shutdown()
+
+
+def open_catalog(name: str) -> CityCatalog:
+    return CityCatalog(CATALOG_PATH, name)
@@ -2,25 +2,41 @@ from uagents import Agent, Context, Protocol  # type: ignore
 from utils import create_agent, get_items
 from models import *
 from typing import Dict
-from random import randint
-from uagents.network import wait_for_tx_to_complete # type: ignore
-from utils import sync_query
-from uagents.envelope import Envelope  # type: ignore
-from uagents.query import query  # type: ignore
-import json
+from ids import new_id
+from ledger import get_ledger, wait_for_tx, coin_received_events
+from transport import transport
+from scheduler import PaymentScheduler, PaymentMetrics
+from paylog import get_payment_log
+from time import time
+from os import getenv
+from env import env_flag
+import asyncio
 
 payment_protocol = Protocol(
     name="payment_protocol", version="1.0")
 
+payment_scheduler = PaymentScheduler()
+payment_metrics = PaymentMetrics()
+payment_log = get_payment_log()
+
+# Payer requests in flight at once, and seconds each payment gets to be requested and confirmed
+PAYMENT_CONCURRENCY = int(getenv("PAYMENT_CONCURRENCY", 32))
+PAYMENT_DEADLINE = float(getenv("PAYMENT_DEADLINE", 240))
+# Seconds an unconfirmed tx keeps being looked up before its payment is charged again
+PAYMENT_PENDING_EXPIRY = float(getenv("PAYMENT_PENDING_EXPIRY", 3600))
+# Settle all of a payer's due payments with one multi-recipient transaction per cycle
+PAYMENT_BATCHING = env_flag("PAYMENT_BATCHING")
+# Seconds between merges of small sealed payment log segments
+PAYMENT_LOG_COMPACT_INTERVAL = float(getenv("PAYMENT_LOG_COMPACT_INTERVAL", 3600))
+
 
 @payment_protocol.on_query(model=PaymentCancel, replies={Response})
 async def cancel_payment(context: Context, sender: str, request: PaymentCancel):
     print(f'{request=}')
-    payments = context.storage.get("payments")
-    if request.id in payments.keys():
-        del payments[request.id]
-        context.storage.set("payments", payments)
-        print(f"Payment cancelled {payments}")
+    payment, _ = context.storage.update("payments", [request.id], lambda payment: None)
+    if payment:
+        payment_log.append("cancelled", request.id, payment)
+        print(f"Payment cancelled {payment}")
         await context.send(destination=sender, message=Response(status=True, content="Payment cancelled"))
     else:
         await context.send(destination=sender, message=Response(status=False, content="Payment not found"))
@@ -28,41 +44,180 @@ async def cancel_payment(context: Context, sender: str, request: PaymentCancel):
 
 @payment_protocol.on_query(model=PaymentRequest, replies={Response})
 async def get_payment(context: Context, sender: str, request: PaymentRequest):
-    items = context.storage.get("payments")
-
-    payment_id = randint(1000, 9999)
-    items[payment_id] = {
+    payment_id = new_id()
+    payment = {
         "from": request.from_address,
         "to": request.to_address,
+        "to_agent": request.to_agent,
         "amount": request.amount,
         "repeat": 60 * request.frequency,
-        "remaining": 0
+        "next_due": time()
     }
 
-    context.storage.set("payments", items)
+    context.storage.put("payments", [payment_id], payment)
+    payment_log.append("created", payment_id, payment, repeat=payment["repeat"])
+    if payment_scheduler.loaded:
+        payment_scheduler.schedule(payment_id, payment["next_due"])
     await context.send(destination=sender, message=Response(status=True, content=payment_id))
 
 
+async def request_payment(payer: str, request: Model, semaphore: asyncio.Semaphore, deadline: float) -> Optional[str]:
+    async with semaphore:
+        timeout = deadline - time()
+        if timeout <= 0:
+            return None
+        data = await transport.query_json(payer, request, timeout=timeout)
+    if not data or not data["status"]:
+        return None
+    return data["content"]
+
+
+async def confirm_payments(context: Context, payments: List[Dict], transaction: str, deadline: float) -> List[Optional[bool]]:
+    """Per payment: True if the tx carries its transfer, False if the tx landed without it, None if unconfirmed."""
+    try:
+        tx_resp = await asyncio.wait_for(wait_for_tx(transaction, get_ledger(context)), deadline - time())
+    except asyncio.TimeoutError:
+        context.logger.info(f"Transaction {transaction} was not confirmed before its deadline")
+        return [None] * len(payments)
+
+    # Match each payment to its own coin_received event, so one tx can settle several payments
+    events = coin_received_events(tx_resp)
+    results: List[Optional[bool]] = []
+    for payment in payments:
+        coin_received = next((
+            event for event in events
+            if event["receiver"] == payment["to"] and event["amount"] == f"{payment["amount"]}atestfet"
+        ), None)
+        if coin_received:
+            events.remove(coin_received)
+            context.logger.info(f"Transaction was successful: {coin_received}")
+        else:
+            context.logger.info(f"Transaction failed: {transaction} has no transfer of {payment["amount"]}atestfet to {payment["to"]}")
+        results.append(coin_received is not None)
+    return results
+
+
+def finish_payment(payment_id: str, payment: Dict, settled: Optional[bool], transaction: Optional[str], now: float) -> None:
+    pending_since = payment.pop("pending_since", now)
+    payment.pop("pending_tx", None)
+    payment_metrics.record(bool(settled))
+    if settled:
+        payment_scheduler.reschedule(payment_id, payment, now)
+        payment_log.append("settled", payment_id, payment, tx=transaction)
+        return
+
+    if settled is None and transaction:
+        # The transfer may still land, so the retry checks this tx before charging the period again
+        payment["pending_tx"] = transaction
+        payment["pending_since"] = pending_since
+    payment_scheduler.retry(payment_id, payment, now)
+    payment_log.append("unconfirmed" if "pending_tx" in payment else "failed", payment_id, payment, tx=transaction)
+
+
+async def resolve_pending(context: Context, due: List[Tuple[str, Dict]], now: float) -> List[Tuple[str, Dict]]:
+    """Settles payments whose earlier, unconfirmed tx has landed since; returns the ones still to be charged."""
+    charge = [(payment_id, payment) for payment_id, payment in due if not payment.get("pending_tx")]
+    pending: Dict[str, List[Tuple[str, Dict]]] = {}
+    for payment_id, payment in due:
+        if payment.get("pending_tx"):
+            pending.setdefault(payment["pending_tx"], []).append((payment_id, payment))
+
+    # Half the deadline for the lookup, leaving the rest for a fresh charge
+    deadline = now + PAYMENT_DEADLINE / 2
+    for transaction, payments in pending.items():
+        results = await confirm_payments(context, [payment for _, payment in payments], transaction, deadline)
+        for (payment_id, payment), settled in zip(payments, results):
+            if settled:
+                finish_payment(payment_id, payment, True, transaction, now)
+            elif settled is None and now - payment.get("pending_since", now) < PAYMENT_PENDING_EXPIRY:
+                # Still unconfirmed: look it up again next tick rather than risk charging twice
+                context.logger.info(f"Transaction {transaction} for {payment_id} is still unconfirmed, checking again later")
+                finish_payment(payment_id, payment, None, transaction, now)
+            else:
+                reason = "never paid" if settled is False else "expired unconfirmed for"
+                context.logger.info(f"Transaction {transaction} {reason} {payment_id}, charging again")
+                payment.pop("pending_tx")
+                payment.pop("pending_since", None)
+                charge.append((payment_id, payment))
+    return charge
+
+
+async def settle_payments(context: Context, payer: str, due: List[Tuple[str, Dict]], semaphore: asyncio.Semaphore, now: float) -> None:
+    deadline = now + PAYMENT_DEADLINE
+    due = await resolve_pending(context, due, now)
+    if not due:
+        return
+    transfers = [TransactionRequest(to_address=payment["to"], amount=payment["amount"]) for _, payment in due]
+    request = transfers[0] if len(transfers) == 1 else BatchTransactionRequest(transactions=transfers)
+
+    transaction = await request_payment(payer, request, semaphore, deadline)
+    if not transaction:
+        for payment_id, payment in due:
+            finish_payment(payment_id, payment, False, None, now)
+        return
+
+    # Confirmation runs outside the dispatch semaphore, so new payer requests keep flowing meanwhile
+    results = await confirm_payments(context, [payment for _, payment in due], transaction, deadline)
+    for (payment_id, payment), settled in zip(due, results):
+        finish_payment(payment_id, payment, settled, transaction, now)
+
+
+def billing_state(current: Optional[Dict], payment: Dict) -> Optional[Dict]:
+    """`current` with the scheduling fields of this cycle's copy of the payment; None stays cancelled."""
+    if current is None:
+        return None
+    state = {key: value for key, value in current.items() if key not in ("pending_tx", "pending_since")}
+    state["next_due"] = payment["next_due"]
+    if "pending_tx" in payment:
+        state["pending_tx"] = payment["pending_tx"]
+        state["pending_since"] = payment["pending_since"]
+    return state
+
+
 @payment_protocol.on_interval(period=60)
 async def check_payments(context: Context):
     payments = context.storage.get("payments")
-    for payment in payments.values():
-        if payment["remaining"] == 0:
-            data = await query(destination=payment["from"], message=TransactionRequest(to_address=payment["to"], amount=payment["amount"]), timeout=240.0)
-            if not isinstance(data, Envelope):
-                continue
-            transaction = json.loads(data.decode_payload())["content"]
-            tx_resp = await wait_for_tx_to_complete(transaction, context.ledger)
-            coin_received = tx_resp.events["coin_received"]
-            if (
-                coin_received["receiver"] == payment["to"]
-                and coin_received["amount"] == f"{payment["amount"]}atestfet"
-            ):
-                context.logger.info(f"Transaction was successful: {coin_received}")
-            else:
-                context.logger.info(f"Transaction failed: {coin_received}")
+    now = time()
+    if not payment_scheduler.loaded:
+        payment_scheduler.load(payments, now)
+
+    due = list(payment_scheduler.due(payments, now))
+    if not due:
+        return
+
+    if PAYMENT_BATCHING:
+        batches: Dict[str, List[Tuple[str, Dict]]] = {}
+        for payment_id, payment in due:
+            batches.setdefault(payment["from"], []).append((payment_id, payment))
+        groups = list(batches.items())
+    else:
+        groups = [(payment["from"], [(payment_id, payment)]) for payment_id, payment in due]
 
-        payment["remaining"] -= 1
+    payment_metrics.start(len(due))
+    semaphore = asyncio.Semaphore(PAYMENT_CONCURRENCY)
+    await asyncio.gather(*(
+        settle_payments(context, payer, group, semaphore, now) for payer, group in groups))
+    payment_metrics.finish()
+
+    # Only the due payments changed, so write just those; ones cancelled mid-cycle stay deleted
+    with context.storage.batch():
+        for payment_id, payment in due:
+            context.storage.update("payments", [payment_id], lambda current: billing_state(current, payment))
+    context.logger.info(payment_metrics.summary())
+
+
+@payment_protocol.on_query(model=PaymentHistoryRequest, replies={Response})
+async def get_payment_history(context: Context, sender: str, request: PaymentHistoryRequest):
+    events, cursor = payment_log.history(
+        request.address, request.role, request.payment_id, request.before, min(max(request.limit, 1), 100))
+    await context.send(destination=sender, message=Response(status=True, content={"events": events, "next": cursor}))
+
+
+@payment_protocol.on_interval(period=PAYMENT_LOG_COMPACT_INTERVAL)
+async def compact_payment_log(context: Context):
+    merged = await asyncio.get_running_loop().run_in_executor(None, payment_log.compact)
+    if merged:
+        context.logger.info(f"Compacted {merged} payment log segments")
 
 
 user_central_link_protocol = Protocol(
@@ -99,12 +254,11 @@ async def get_location_by_query(context: Context, sender: str, request: AgentReq
 
 @user_central_link_protocol.on_message(model=UserLocationLink, replies={Response})
 async def activate_user(context: Context, sender: str, request: UserLocationLink):
-    users: Dict[str, Dict] = context.storage.get("users")
-    if request.id in users.keys():
+    user, _ = context.storage.update(
+        "users", [request.id], lambda user: user or {"agent": sender, "location": request.location})
+    if user:
         await context.send(destination=sender, message=Response(status=False, content="User already activated"))
     else:
-        users[request.id] = {"agent": sender, "location": request.location}
-        context.storage.set("users", users)
         await context.send(destination=sender, message=Response(status=True, content="User activated"))
 
 city_central_link_protocol = Protocol(
@@ -113,23 +267,19 @@ city_central_link_protocol = Protocol(
 
 @city_central_link_protocol.on_message(model=LocationRegistrationRequest, replies={LocationRegistrationResponse})
 async def set_location(context: Context, sender: str, request: LocationRegistrationRequest):
-    locations: Dict[str, str] = context.storage.get("locations")
-    if request.location in locations.keys():
+    address, _ = context.storage.update("locations", [request.location], lambda address: address or request.address)
+    if address:
         context.logger.info(f"Location {request.location} already exists")
         await context.send(destination=sender, message=LocationRegistrationResponse(status=False, items=context.storage.get("items")))
     else:
-        locations[request.location] = request.address
-        context.storage.set("locations", locations)
         context.logger.info(f"Location {request.location} registered")
         await context.send(destination=sender, message=LocationRegistrationResponse(status=True, items=context.storage.get("items")))
 
 
 @city_central_link_protocol.on_message(model=LocationUnregistrationRequest, replies={LocationUnregistrationResponse})
 async def remove_location(context: Context, sender: str, request: LocationUnregistrationRequest):
-    locations: Dict[str, str] = context.storage.get("locations")
-    if request.location in locations.keys():
-        del locations[request.location]
-        context.storage.set("locations", locations)
+    address, _ = context.storage.update("locations", [request.location], lambda address: None)
+    if address:
         context.logger.info(f"Location {request.location} unregistered")
     else:
         context.logger.info(f"Location {request.location} not found")
@@ -6,13 +6,31 @@ from uagents import Agent, Context, Protocol  # type: ignore
 from utils import create_agent
 from models import *
 from utils import get_agents, AgentData
-from random import choice
-from string import digits
-from typing import Dict
+from ids import new_id
+from catalog import CityCatalog, open_catalog
+from search import (SEARCH_CONCURRENCY, SEARCH_MODE, SEARCH_TIMEOUT, BM25Index, CatalogSearch, SearchCache,
+                    SingleFlight, VectorIndex, invoke_chain, search_key)
+from typing import Dict, Set
+from time import perf_counter
 from dotenv import load_dotenv
+import asyncio
+import sys
 load_dotenv()
 
-chain: Any = None
+# LLM chains per city agent address, so several cities can share one process
+chains: Dict[str, Any] = {}
+# Listings per city agent address
+catalogs: Dict[str, CityCatalog] = {}
+# Search indexes over each city's listings: BM25 to pick what the LLM sees, or vectors to answer directly
+searches: Dict[str, CatalogSearch] = {}
+# Recent search answers per city agent address
+search_caches: Dict[str, SearchCache] = {}
+# Searches in progress per city agent address, shared by identical requests that arrive meanwhile
+search_flights: Dict[str, SingleFlight] = {}
+# Bounds the LLM calls each city agent has in flight
+search_limits: Dict[str, asyncio.Semaphore] = {}
+# Searches being answered in the background, referenced until their reply is sent
+search_tasks: Set[asyncio.Task] = set()
 
 
 class RelatedItems(BaseModel):
@@ -62,14 +80,21 @@ search_protocol = Protocol(
     name="search_protocol", version="1.0")
 
 
-@search_protocol.on_query(model=SearchRequest, replies={SearchResponse})
-async def search(context: Context, sender: str, request: SearchRequest):
-    items = context.storage.get("items")
-    data = create_data(items[request.category])
-    global chain
+async def answer(context: Context, request: SearchRequest) -> SearchResponse:
+    if SEARCH_MODE == "vector":
+        ranked = searches[context.agent.address].ranked(request.category, request.query)
+        return SearchResponse(
+            response=f"Here are the listings closest to \"{request.query}\".",
+            items=[(owner, Item(**item)) for owner, item in ranked])
 
-    response = chain.invoke(
-        {"query": request.query, "history": request.history, "data": data})
+    items = catalogs[context.agent.address].items
+    # Only the best matching listings go into the prompt, not the whole category
+    data = create_data(searches[context.agent.address].candidates(request.category, request.query))
+    chain = chains[context.agent.address]
+
+    response = await invoke_chain(
+        chain, {"query": request.query, "history": request.history, "data": data},
+        search_limits[context.agent.address])
     
     related_items = []
     
@@ -78,26 +103,60 @@ async def search(context: Context, sender: str, request: SearchRequest):
             if item["name"] in items[request.category][item["user_id"]]:
                 related_items.append((item["user_id"], Item(**items[request.category][item["user_id"]][item["name"]])))      
 
-    await context.send(destination=sender, message=SearchResponse(response=response["response"], items=related_items))
+    return SearchResponse(response=response["response"], items=related_items)
+
+
+@search_protocol.on_query(model=SearchRequest, replies={SearchResponse})
+async def search(context: Context, sender: str, request: SearchRequest):
+    # uagents runs an agent's handlers one at a time, so the search replies from a task of its
+    # own; awaiting the LLM here would hold every add, delete and registration behind it
+    task = asyncio.ensure_future(reply_to_search(context, sender, request))
+    search_tasks.add(task)
+    task.add_done_callback(search_tasks.discard)
+
+
+async def reply_to_search(context: Context, sender: str, request: SearchRequest) -> None:
+    cache = search_caches[context.agent.address]
+    # Read the version first: an add landing mid-search leaves the answer under the old version
+    version = catalogs[context.agent.address].version(request.category)
+    key = search_key(request.category, request.query, request.history, version)
+
+    async def compute() -> SearchResponse:
+        start = perf_counter()
+        response = await answer(context, request)
+        cache.put(key, response, perf_counter() - start)
+        return response
+
+    response = cache.get(key)
+    if response is not None:
+        context.logger.info(f"Search cache hit: {cache.stats()}")
+    else:
+        flights = search_flights[context.agent.address]
+        if key in flights.calls:
+            context.logger.info(f"Joining an identical search in progress ({flights.shared + 1} joined so far)")
+        try:
+            response = await flights.do(key, compute)
+        except asyncio.TimeoutError:
+            context.logger.warning(f"Search for \"{request.query}\" gave up after {SEARCH_TIMEOUT}s")
+            response = SearchResponse(response="The search took too long, please try again.", items=[])
+        except Exception as e:
+            context.logger.exception(f"Search for \"{request.query}\" failed: {e}")
+            response = SearchResponse(response="The search failed, please try again.", items=[])
+
+    await context.send(destination=sender, message=response)
 
 
 @item_management_protocol.on_query(model=AddRequest, replies={Response})
 async def add_item(context: Context, sender: str, request: AddRequest):
-    items = context.storage.get("items")
-    if request.agent_address not in items[request.item.category]:
-        items[request.item.category][request.agent_address] = {}
-    items[request.item.category][request.agent_address][request.item.name] = request.item.model_dump()
-    context.storage.set("items", items)
+    catalogs[context.agent.address].add(request.item.category, request.agent_address, request.item.model_dump())
     await context.send(destination=sender, message=Response(status=True, content="Item added"))
 
 
 @item_management_protocol.on_query(model=DeleteRequest, replies={Response})
 async def delete_item(context: Context, sender: str, request: DeleteRequest):
-    items = context.storage.get("items")
-    if request.agent_address in items[request.category]:
-        if request.name in items[request.category][request.agent_address]:
-            items[request.category][request.agent_address].pop(request.name)
-            context.storage.set("items", items)
+    catalog = catalogs[context.agent.address]
+    if request.agent_address in catalog.category(request.category):
+        if catalog.delete(request.category, request.agent_address, request.name):
             await context.send(destination=sender, message=Response(status=True, content="Item deleted"))
             return
         else:
@@ -108,12 +167,10 @@ async def delete_item(context: Context, sender: str, request: DeleteRequest):
 
 @city_central_link_protocol.on_message(model=LocationRegistrationResponse)
 async def register_response(context: Context, sender: str, response: LocationRegistrationResponse):
+    # Re-registering after a restart keeps the catalog; only categories new to this city are added
+    catalogs[context.agent.address].ensure_categories(response.items)
     if response.status:
         context.logger.info(f"Location registered successfully")
-        items: Dict[str, Dict] = {}
-        for item in response.items:
-            items[item] = {}
-        context.storage.set("items", items)
     else:
         context.logger.info(f"Location already exists")
 
@@ -125,21 +182,13 @@ city_user_link_protocol = Protocol(
 @city_user_link_protocol.on_message(model=User, replies={UserID})
 async def receive_user(context: Context, sender: str, user: User):
     if not user.id:
-        users = context.storage.get("users")
-        while True:
-            new_id = "".join(choice(digits) for _ in range(10))
-            if new_id not in users:
-                break
-        user.id = new_id
-        users[user.id] = sender
-        context.storage.set("users", users)
+        user.id = new_id()
+        context.storage.put("users", [user.id], sender)
         context.logger.info(f"User {user.name} registered with ID {user.id}")
     await context.send(destination=sender, message=UserID(id=user.id))
 
 
-def create_city_agent(name: str, central_agent_address: str) -> Agent:
-
-    global chain
+def create_chain() -> Any:
     model = ChatGoogleGenerativeAI(model="gemini-pro")
 
     parser = JsonOutputParser(pydantic_object=ResponseData)
@@ -150,11 +199,18 @@ def create_city_agent(name: str, central_agent_address: str) -> Agent:
         partial_variables={
             "format_instructions": parser.get_format_instructions()},
     )
-    chain = prompt | model | parser
-    
-    async def register(context: Context) -> None:
+    return prompt | model | parser
 
 
+def create_city_agent(name: str, central_agent_address: str, port: Optional[int] = None) -> Agent:
+
+    async def register(context: Context) -> None:
+        catalog = catalogs[city_agent.address]
+        if context.storage.has("items"):
+            context.logger.info(f"Moving {name} catalog from storage to {catalog.snapshot_path}...")
+            catalog.load(context.storage.get("items"))
+            context.storage.remove("items")
+
         context.logger.info(f"Registering location {name}...")
 
 
@@ -163,22 +219,34 @@ def create_city_agent(name: str, central_agent_address: str) -> Agent:
     async def unregister(context: Context) -> None:
         context.logger.info(f"Unregistering location {name}...")
         await context.send(destination=central_agent_address, message=LocationUnregistrationRequest(location=name))
+        catalogs[city_agent.address].snapshot()
+        context.logger.info(f"Search cache: {search_caches[city_agent.address].stats()}")
 
     city_agent: Agent = create_agent(
         f"{name}",
         secret=f"{name}_secret",
-        storage_initials={"users": {}, "items": {}},
+        port=port,
+        storage_initials={"users": {}},
         protocols=[city_central_link_protocol, city_user_link_protocol,
                    item_management_protocol, search_protocol],
         custom_startup_function=register,
         custom_shutdown_function=unregister
     )
 
+    if SEARCH_MODE != "vector":
+        chains[city_agent.address] = create_chain()
+    catalogs[city_agent.address] = open_catalog(name)
+    searches[city_agent.address] = CatalogSearch(
+        catalogs[city_agent.address], VectorIndex if SEARCH_MODE == "vector" else BM25Index)
+    search_caches[city_agent.address] = SearchCache()
+    search_flights[city_agent.address] = SingleFlight()
+    search_limits[city_agent.address] = asyncio.Semaphore(SEARCH_CONCURRENCY)
+
     return city_agent
 
 
 if __name__ == "__main__":
-    city_name = input("Enter city name: ")
+    city_name = sys.argv[1] if len(sys.argv) > 1 else input("Enter city name: ")
     central_agent_data: AgentData = get_agents("central_agent")
 
     if not central_agent_data.agent_address:
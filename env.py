@@ -0,0 +1,9 @@
+from os import getenv
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def env_flag(name: str) -> bool:
+    """True when the environment variable is set to 1, true or yes, in any case."""
+    return getenv(name, "").lower() in ("1", "true", "yes")
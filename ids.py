@@ -0,0 +1,141 @@
+from collections import deque
+from os import getenv
+from secrets import randbelow
+from threading import Lock
+from time import sleep, time
+from typing import Deque, Dict, Iterable, Optional, Set, Tuple
+from dotenv import load_dotenv
+from registry import get_registry
+
+load_dotenv()
+
+# 2024-01-01T00:00:00Z; 41 bits of milliseconds from here last until 2093
+EPOCH_MS = 1704067200000
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+MAX_NODES = 1 << NODE_BITS
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+class IdGenerator:
+    """Snowflake-style ids: 41 bits of milliseconds, 10 bits of node, 12 bits of sequence.
+
+    Every process leases its own node id, so ids are unique across a sharded
+    fleet without any coordination per id. A node hands out up to 4096 ids
+    per millisecond and waits for the next millisecond past that, or when
+    the clock steps backwards.
+    """
+
+    def __init__(self, node: int) -> None:
+        if not 0 <= node < MAX_NODES:
+            raise ValueError(f"Node id must be in [0, {MAX_NODES}), got {node}")
+        self.node = node
+        self.lock = Lock()
+        self.last_ms = -1
+        self.sequence = 0
+
+    def now_ms(self) -> int:
+        return int(time() * 1000) - EPOCH_MS
+
+    def next_id(self) -> int:
+        with self.lock:
+            now = self.now_ms()
+            if now < self.last_ms:
+                sleep((self.last_ms - now) / 1000)
+                now = max(self.now_ms(), self.last_ms)
+
+            if now == self.last_ms:
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    while now <= self.last_ms:
+                        now = self.now_ms()
+            else:
+                self.sequence = 0
+
+            self.last_ms = now
+            return (now << (NODE_BITS + SEQUENCE_BITS)) | (self.node << SEQUENCE_BITS) | self.sequence
+
+    def next_str(self) -> str:
+        return str(self.next_id())
+
+
+def parse_id(id: int) -> Tuple[float, int, int]:
+    """Splits an id into `(unix time in seconds, node, sequence)`."""
+    return (
+        ((id >> (NODE_BITS + SEQUENCE_BITS)) + EPOCH_MS) / 1000,
+        (id >> SEQUENCE_BITS) & (MAX_NODES - 1),
+        id & MAX_SEQUENCE
+    )
+
+
+_id_generator: Optional[IdGenerator] = None
+_id_generator_lock = Lock()
+
+
+def get_id_generator() -> IdGenerator:
+    """The process-wide generator, on `ID_NODE` if set or a node leased from the registry."""
+    global _id_generator
+    with _id_generator_lock:
+        if _id_generator is None:
+            node = getenv("ID_NODE")
+            _id_generator = IdGenerator(int(node) if node else get_registry().allocate_node(MAX_NODES))
+        return _id_generator
+
+
+def new_id() -> str:
+    return get_id_generator().next_str()
+
+
+class CodePool:
+    """Short numeric codes that are unique within a scope while they are outstanding.
+
+    Released codes sit in quarantine for `quarantine` seconds before they can
+    be drawn again, so a stale code from a finished rental is never accepted
+    for the next one.
+    """
+
+    def __init__(self, digits: int = 4, quarantine: float = 3600.0) -> None:
+        self.digits = digits
+        self.size = 10 ** digits
+        self.quarantine = quarantine
+        self.active: Dict[str, Set[str]] = {}
+        self.released: Dict[str, Deque[Tuple[float, str]]] = {}
+        self.cooling: Dict[str, Set[str]] = {}
+
+    def load(self, scope: str, codes: Iterable[str]) -> None:
+        self.active.setdefault(scope, set()).update(codes)
+
+    def expire(self, scope: str) -> None:
+        released = self.released.get(scope)
+        while released and released[0][0] <= time():
+            self.cooling[scope].discard(released.popleft()[1])
+
+    def allocate(self, scope: str) -> str:
+        self.expire(scope)
+        active = self.active.setdefault(scope, set())
+        cooling = self.cooling.get(scope, set())
+        taken = len(active) + len(cooling)
+        if taken >= self.size:
+            raise RuntimeError(f"No free {self.digits}-digit codes left in scope {scope}")
+
+        if taken < self.size // 2:
+            # Mostly free, so a couple of random draws find a code in expected O(1)
+            while True:
+                code = str(randbelow(self.size)).zfill(self.digits)
+                if code not in active and code not in cooling:
+                    break
+        else:
+            free = [code for code in (str(n).zfill(self.digits) for n in range(self.size))
+                    if code not in active and code not in cooling]
+            code = free[randbelow(len(free))]
+
+        active.add(code)
+        return code
+
+    def release(self, scope: str, code: str) -> None:
+        active = self.active.get(scope)
+        if not active or code not in active:
+            return
+        active.discard(code)
+        self.released.setdefault(scope, deque()).append((time() + self.quarantine, code))
+        self.cooling.setdefault(scope, set()).add(code)
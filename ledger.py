@@ -0,0 +1,260 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from hashlib import sha256
+from itertools import count
+from os import getenv
+from threading import Lock
+from time import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from dotenv import load_dotenv
+from pydantic import BaseModel
+from cosmpy.aerial.exceptions import NotFoundError  # type: ignore
+from cosmpy.aerial.client.bank import create_bank_send_msg  # type: ignore
+from cosmpy.aerial.client.utils import prepare_and_broadcast_basic_transaction  # type: ignore
+from cosmpy.aerial.tx import Transaction  # type: ignore
+from uagents import Context  # type: ignore
+from uagents.network import wait_for_tx_to_complete  # type: ignore
+import asyncio
+import json
+import sqlite3
+
+load_dotenv()
+
+
+class LocalMessageLog(BaseModel):
+    index: int
+    events: Dict[str, Dict[str, str]]
+
+
+class LocalTxResponse(BaseModel):
+    hash: str
+    height: int
+    events: Dict[str, Dict[str, str]]
+    logs: List[LocalMessageLog]
+
+
+class LocalSubmittedTx(BaseModel):
+    tx_hash: str
+
+
+class LocalLedger(ABC):
+    """Chain stand-in with the parts of the ledger API the agents use.
+
+    `send_tokens` moves balances immediately and returns a tx hash; the tx
+    only becomes visible to `query_tx` after `confirmation_latency` seconds,
+    with the same `coin_received` event shape the real chain reports.
+    """
+
+    def __init__(self, confirmation_latency: float = 0.0, initial_balance: int = 10 ** 18) -> None:
+        self.confirmation_latency = confirmation_latency
+        self.initial_balance = initial_balance
+        self.lock = Lock()
+        self.nonce = count()
+
+    def tx_hash(self, sender: str, transfers: List[Tuple[str, Any]], denom: str) -> str:
+        return sha256(f"{sender}:{transfers}{denom}:{next(self.nonce)}:{time()}".encode()).hexdigest().upper()
+
+    def send_tokens(
+        self,
+        destination: Any,
+        amount: Any,
+        denom: str,
+        sender: Any,
+        memo: Optional[str] = None,
+        gas_limit: Optional[int] = None
+    ) -> LocalSubmittedTx:
+        return self.send_tokens_batch([(destination, amount)], denom, sender)
+
+    def send_tokens_batch(self, transfers: List[Tuple[Any, Any]], denom: str, sender: Any) -> LocalSubmittedTx:
+        """Moves tokens to several recipients in one transaction, one message per transfer."""
+        sender_address = str(sender.address()) if hasattr(sender, "address") else str(sender)
+        transfers = [(str(destination), amount) for destination, amount in transfers]
+        total = sum(amount for _, amount in transfers)
+
+        with self.transaction():
+            balance = self.balance(sender_address, denom)
+            if balance < total:
+                raise ValueError(f"Insufficient funds: {balance}{denom} < {total}{denom}")
+            self.set_balance(sender_address, denom, balance - total)
+
+            logs = []
+            for destination, amount in transfers:
+                self.set_balance(destination, denom, self.balance(destination, denom) + amount)
+                logs.append({
+                    "coin_spent": {"spender": sender_address, "amount": f"{amount}{denom}"},
+                    "coin_received": {"receiver": destination, "amount": f"{amount}{denom}"},
+                    "transfer": {"recipient": destination, "sender": sender_address, "amount": f"{amount}{denom}"}
+                })
+
+            tx_hash = self.tx_hash(sender_address, transfers, denom)
+            self.record(tx_hash, logs, time() + self.confirmation_latency)
+
+        return LocalSubmittedTx(tx_hash=tx_hash)
+
+    def query_tx(self, tx_hash: str) -> LocalTxResponse:
+        found = self.lookup(tx_hash)
+        if not found or found[1] > time():
+            raise NotFoundError()
+        logs, _, height = found
+        # Like the chain's flattened tx events, later messages overwrite earlier ones
+        events: Dict[str, Dict[str, str]] = {}
+        for log in logs:
+            events.update(log)
+        return LocalTxResponse(
+            hash=tx_hash,
+            height=height,
+            events=events,
+            logs=[LocalMessageLog(index=index, events=log) for index, log in enumerate(logs)]
+        )
+
+    def query_bank_balance(self, address: Any, denom: str = "atestfet") -> int:
+        return self.balance(str(address), denom)
+
+    async def wait_for_tx(self, tx_hash: str, timeout: float = 120.0, poll_period: float = 0.05) -> LocalTxResponse:
+        deadline = time() + timeout
+        while True:
+            found = self.lookup(tx_hash)
+            if found and found[1] <= time():
+                return self.query_tx(tx_hash)
+            if time() > deadline:
+                raise asyncio.TimeoutError(f"Transaction {tx_hash} was not confirmed in time")
+            await asyncio.sleep(max(poll_period, found[1] - time()) if found else poll_period)
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        with self.lock:
+            yield
+
+    @abstractmethod
+    def balance(self, address: str, denom: str) -> int:
+        ...
+
+    @abstractmethod
+    def set_balance(self, address: str, denom: str, amount: Any) -> None:
+        ...
+
+    @abstractmethod
+    def record(self, tx_hash: str, logs: List[Dict[str, Dict[str, str]]], confirmed_at: float) -> None:
+        ...
+
+    @abstractmethod
+    def lookup(self, tx_hash: str) -> Optional[tuple]:
+        """Returns `(logs, confirmed_at, height)` for a recorded tx, or None."""
+
+
+class MemoryLedger(LocalLedger):
+    """Ledger kept in process memory; only agents in the same process share it."""
+
+    def __init__(self, confirmation_latency: float = 0.0, initial_balance: int = 10 ** 18) -> None:
+        super().__init__(confirmation_latency, initial_balance)
+        self.balances: Dict[tuple, Any] = {}
+        self.txs: Dict[str, tuple] = {}
+
+    def balance(self, address: str, denom: str) -> int:
+        return self.balances.get((address, denom), self.initial_balance)
+
+    def set_balance(self, address: str, denom: str, amount: Any) -> None:
+        self.balances[(address, denom)] = amount
+
+    def record(self, tx_hash: str, logs: List[Dict[str, Dict[str, str]]], confirmed_at: float) -> None:
+        self.txs[tx_hash] = (logs, confirmed_at, len(self.txs) + 1)
+
+    def lookup(self, tx_hash: str) -> Optional[tuple]:
+        return self.txs.get(tx_hash)
+
+
+class SQLiteLedger(LocalLedger):
+    """Ledger kept in a SQLite file, so agents in separate processes share it."""
+
+    def __init__(self, file_path: str, confirmation_latency: float = 0.0, initial_balance: int = 10 ** 18) -> None:
+        super().__init__(confirmation_latency, initial_balance)
+        self.connection = sqlite3.connect(file_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS balances (address TEXT, denom TEXT, amount REAL, PRIMARY KEY (address, denom))")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS txs (height INTEGER PRIMARY KEY AUTOINCREMENT, hash TEXT UNIQUE, logs TEXT, confirmed_at REAL)")
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        # BEGIN IMMEDIATE takes the write lock up front, so transfers from other processes serialize
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def balance(self, address: str, denom: str) -> int:
+        row = self.connection.execute(
+            "SELECT amount FROM balances WHERE address = ? AND denom = ?", (address, denom)).fetchone()
+        return row[0] if row else self.initial_balance
+
+    def set_balance(self, address: str, denom: str, amount: Any) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO balances (address, denom, amount) VALUES (?, ?, ?)", (address, denom, amount))
+
+    def record(self, tx_hash: str, logs: List[Dict[str, Dict[str, str]]], confirmed_at: float) -> None:
+        self.connection.execute(
+            "INSERT INTO txs (hash, logs, confirmed_at) VALUES (?, ?, ?)", (tx_hash, json.dumps(logs), confirmed_at))
+
+    def lookup(self, tx_hash: str) -> Optional[tuple]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT logs, confirmed_at, height FROM txs WHERE hash = ?", (tx_hash,)).fetchone()
+        if not row:
+            return None
+        return json.loads(row[0]), row[1], row[2]
+
+
+_local_ledger: Optional[LocalLedger] = None
+_local_ledger_lock = Lock()
+
+
+def get_local_ledger() -> Optional[LocalLedger]:
+    """Builds the ledger selected by `LEDGER_BACKEND` ("memory" or "sqlite"), if any."""
+    global _local_ledger
+    backend = getenv("LEDGER_BACKEND", "").lower()
+    if backend not in ("memory", "sqlite"):
+        return None
+
+    with _local_ledger_lock:
+        if _local_ledger is None:
+            latency = float(getenv("LEDGER_CONFIRMATION_LATENCY", 0))
+            if backend == "memory":
+                _local_ledger = MemoryLedger(latency)
+            else:
+                _local_ledger = SQLiteLedger(getenv("LEDGER_PATH", "ledger.db"), latency)
+    return _local_ledger
+
+
+def get_ledger(context: Context) -> Any:
+    return get_local_ledger() or context.ledger
+
+
+def send_tokens_batch(ledger: Any, transfers: List[Tuple[str, Any]], denom: str, wallet: Any) -> Any:
+    """Sends one transaction with a bank send message per `(destination, amount)` transfer."""
+    if isinstance(ledger, LocalLedger):
+        return ledger.send_tokens_batch(transfers, denom, wallet)
+
+    tx = Transaction()
+    for destination, amount in transfers:
+        tx.add_message(create_bank_send_msg(wallet.address(), destination, amount, denom))
+    return prepare_and_broadcast_basic_transaction(ledger, tx, wallet)
+
+
+def coin_received_events(tx_resp: Any) -> List[Dict[str, str]]:
+    """One `coin_received` event per message, falling back to the flattened tx events."""
+    logs = getattr(tx_resp, "logs", None) or []
+    events = [log.events["coin_received"] for log in logs if "coin_received" in log.events]
+    if not events and "coin_received" in tx_resp.events:
+        events = [tx_resp.events["coin_received"]]
+    return events
+
+
+async def wait_for_tx(tx_hash: str, ledger: Any) -> Any:
+    if isinstance(ledger, LocalLedger):
+        return await ledger.wait_for_tx(tx_hash)
+    return await wait_for_tx_to_complete(tx_hash, ledger)
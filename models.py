@@ -1,5 +1,5 @@
 from uagents import Model  # type: ignore
-from typing import Optional, Any, List, Tuple
+from typing import Optional, Any, List, Literal, Tuple
 
 
 class LocationRequest(Model):
@@ -114,6 +114,7 @@ class SearchResponse(Model):
 
 class RequestedItem(Model):
     item: Item
+    owner: Optional[str] = None
 
 
 class HandOverRequest(Model):
@@ -140,6 +141,7 @@ class HandOverEnd(Model):
 
 class HandOverEndConfirm(Model):
     item: Item
+    owner: Optional[str] = None
 
 class WalletRequest(Model):
     any: Any
@@ -150,6 +152,8 @@ class PaymentRequest(Model):
     to_address: str
     amount: float
     frequency: int
+    # Agent owning `to_address`, so the payee finds the payment in its history
+    to_agent: Optional[str] = None
 
 
 class PaymentCancel(Model):
@@ -158,4 +162,17 @@ class PaymentCancel(Model):
 
 class TransactionRequest(Model):
     to_address: str
-    amount: float
\ No newline at end of file
+    amount: float
+
+
+class BatchTransactionRequest(Model):
+    transactions: List[TransactionRequest]
+
+
+class PaymentHistoryRequest(Model):
+    address: Optional[str] = None
+    role: Literal["payer", "payee", "any"] = "any"
+    payment_id: Optional[str] = None
+    # `next` cursor from the previous page; None for the newest events
+    before: Optional[int] = None
+    limit: int = 20
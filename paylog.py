@@ -0,0 +1,266 @@
+from bisect import bisect_left
+from json import dumps, loads, load, dump
+from os import getenv, listdir, makedirs, path, remove, replace
+from threading import Lock
+from time import time
+from typing import Any, Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+INDEXES = ("payer", "payee", "payment")
+
+
+def event_keys(event: Dict[str, Any]) -> List[Tuple[str, str]]:
+    """The `(index, key)` postings of an event; payees are found by wallet and by agent address."""
+    keys = [("payer", event.get("from")), ("payee", event.get("to")), ("payee", event.get("to_agent")),
+            ("payment", event.get("payment_id"))]
+    return [(name, str(key)) for name, key in keys if key]
+
+
+class SegmentIndex:
+    """Offsets and payer/payee/payment_id postings for the events of one segment.
+
+    `size` is the segment's length in bytes when the index was written; an
+    index whose size no longer matches its segment is stale and rebuilt.
+    """
+
+    def __init__(self, first_seq: int) -> None:
+        self.first_seq = first_seq
+        self.size = 0
+        self.offsets: List[int] = []
+        self.postings: Dict[str, Dict[str, List[int]]] = {name: {} for name in INDEXES}
+
+    def add(self, seq: int, offset: int, event: Dict[str, Any]) -> None:
+        self.offsets.append(offset)
+        for name, key in event_keys(event):
+            self.postings[name].setdefault(key, []).append(seq)
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"first_seq": self.first_seq, "size": self.size, "offsets": self.offsets, "postings": self.postings}
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "SegmentIndex":
+        index = cls(data["first_seq"])
+        index.size = data.get("size", -1)
+        index.offsets = data["offsets"]
+        index.postings = data["postings"]
+        return index
+
+
+class PaymentLog:
+    """Append-only, segmented log of payment events with indexed history lookups.
+
+    Events are JSON lines in `segment-NNNNNN.log` files. When the active
+    segment passes `segment_size` bytes it is sealed and its index is written
+    next to it, so a restart only rescans the active segment. History pages
+    are found by bisecting a per-address list of sequence numbers, then read
+    by seeking straight to each event.
+    """
+
+    def __init__(self, directory: str, segment_size: int = 4 * 1024 * 1024) -> None:
+        self.directory = directory
+        self.segment_size = segment_size
+        self.lock = Lock()
+        self.segments: List[Tuple[str, SegmentIndex]] = []
+        self.postings: Dict[str, Dict[str, List[int]]] = {name: {} for name in INDEXES}
+        self.locations: List[Tuple[int, int]] = []
+        makedirs(directory, exist_ok=True)
+        self.load()
+
+    def segment_path(self, number: int) -> str:
+        return path.join(self.directory, f"segment-{number:06d}.log")
+
+    def index_path(self, segment: str) -> str:
+        return f"{segment[:-len('.log')]}.idx"
+
+    def load(self) -> None:
+        segments = sorted(name for name in listdir(self.directory) if name.startswith("segment-") and name.endswith(".log"))
+        for name in segments:
+            segment = path.join(self.directory, name)
+            if self.first_seq(segment) < len(self.locations):
+                # Already merged into an earlier segment by a compaction that crashed before cleaning up
+                self.discard(segment)
+                continue
+            index = None
+            if path.exists(self.index_path(segment)):
+                with open(self.index_path(segment), 'r') as file:
+                    index = SegmentIndex.from_json(load(file))
+            if index is None or index.size != path.getsize(segment):
+                index = self.scan(segment, len(self.locations))
+            self.attach(segment, index)
+        if not self.segments:
+            self.attach(self.segment_path(0), SegmentIndex(0))
+        elif path.exists(self.index_path(self.segments[-1][0])):
+            # The last segment was sealed before the restart, so start a fresh active one
+            self.roll()
+
+    def first_seq(self, segment: str) -> int:
+        with open(segment, 'rb') as file:
+            line = file.readline()
+        return loads(line)["seq"] if line.endswith(b"\n") else len(self.locations)
+
+    def discard(self, segment: str) -> None:
+        for file_path in (self.index_path(segment), segment):
+            if path.exists(file_path):
+                remove(file_path)
+
+    def scan(self, segment: str, first_seq: int) -> SegmentIndex:
+        index = SegmentIndex(first_seq)
+        with open(segment, 'rb+') as file:
+            offset = 0
+            for line in file:
+                if not line.endswith(b"\n"):
+                    # Drop an event torn by a crash mid-write
+                    file.truncate(offset)
+                    break
+                index.add(first_seq + len(index.offsets), offset, loads(line))
+                offset += len(line)
+        index.size = offset
+        return index
+
+    def attach(self, segment: str, index: SegmentIndex) -> None:
+        number = len(self.segments)
+        self.segments.append((segment, index))
+        self.locations.extend((number, offset) for offset in index.offsets)
+        for name in INDEXES:
+            for key, seqs in index.postings[name].items():
+                self.postings[name].setdefault(key, []).extend(seqs)
+
+    def append(self, kind: str, payment_id: str, payment: Dict[str, Any], **details: Any) -> int:
+        with self.lock:
+            seq = len(self.locations)
+            event = {
+                "seq": seq,
+                "time": time(),
+                "type": kind,
+                "payment_id": str(payment_id),
+                "from": payment.get("from"),
+                "to": payment.get("to"),
+                "to_agent": payment.get("to_agent"),
+                "amount": payment.get("amount"),
+                **details
+            }
+            segment, index = self.segments[-1]
+            line = (dumps(event) + "\n").encode()
+            with open(segment, 'ab') as file:
+                offset = file.tell()
+                file.write(line)
+
+            index.add(seq, offset, event)
+            index.size = offset + len(line)
+            self.locations.append((len(self.segments) - 1, offset))
+            for name, key in event_keys(event):
+                self.postings[name].setdefault(key, []).append(seq)
+
+            if offset + len(line) >= self.segment_size:
+                self.roll()
+            return seq
+
+    def roll(self) -> None:
+        segment, index = self.segments[-1]
+        self.write_index(segment, index)
+        self.segments.append((self.segment_path(self.segment_number(segment) + 1), SegmentIndex(len(self.locations))))
+
+    def segment_number(self, segment: str) -> int:
+        return int(path.basename(segment)[len("segment-"):-len(".log")])
+
+    def write_index(self, segment: str, index: SegmentIndex) -> None:
+        temp_path = f"{self.index_path(segment)}.tmp"
+        with open(temp_path, 'w') as file:
+            dump(index.to_json(), file)
+        replace(temp_path, self.index_path(segment))
+
+    def read(self, seq: int) -> Dict[str, Any]:
+        number, offset = self.locations[seq]
+        with open(self.segments[number][0], 'rb') as file:
+            file.seek(offset)
+            return loads(file.readline())
+
+    def page(self, seqs: List[int], before: Optional[int], limit: int) -> List[int]:
+        end = len(seqs) if before is None else bisect_left(seqs, before)
+        return seqs[max(0, end - limit):end]
+
+    def history(
+        self,
+        address: Optional[str] = None,
+        role: str = "any",
+        payment_id: Optional[str] = None,
+        before: Optional[int] = None,
+        limit: int = 20
+    ) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """Returns up to `limit` events older than the `before` cursor, newest first, and the next cursor."""
+        with self.lock:
+            if payment_id is not None:
+                lists = [self.postings["payment"].get(str(payment_id), [])]
+            else:
+                names = ["payer", "payee"] if role == "any" else [role]
+                lists = [self.postings[name].get(address or "", []) for name in names]
+
+            seqs = sorted({seq for seqs in lists for seq in self.page(seqs, before, limit)})[-limit:]
+            events = [self.read(seq) for seq in reversed(seqs)]
+
+            older = any(self.page(seqs_list, seqs[0], 1) for seqs_list in lists) if seqs else False
+            return events, (seqs[0] if older else None)
+
+    def compact(self, target_size: Optional[int] = None) -> int:
+        """Merges runs of small sealed segments into larger ones; returns how many were merged away."""
+        target_size = target_size or self.segment_size
+        with self.lock:
+            sealed = self.segments[:-1]
+        runs: List[List[int]] = [[]]
+        size = 0
+        for number, (segment, _) in enumerate(sealed):
+            segment_size = path.getsize(segment)
+            if runs[-1] and size + segment_size > target_size:
+                runs.append([])
+                size = 0
+            runs[-1].append(number)
+            size += segment_size
+
+        merged = 0
+        for run in reversed([run for run in runs if len(run) > 1]):
+            first, last = run[0], run[-1]
+            target = self.segments[first][0]
+            temp_path = f"{target}.compact"
+            index = SegmentIndex(self.segments[first][1].first_seq)
+            with open(temp_path, 'wb') as output:
+                for number in run:
+                    segment, segment_index = self.segments[number]
+                    with open(segment, 'rb') as file:
+                        data = file.read()
+                    base = output.tell()
+                    output.write(data)
+                    index.offsets.extend(base + offset for offset in segment_index.offsets)
+                    for name in INDEXES:
+                        for key, seqs in segment_index.postings[name].items():
+                            index.postings[name].setdefault(key, []).extend(seqs)
+                index.size = output.tell()
+
+            with self.lock:
+                # Index first: until the segment is swapped in, its size marks the index stale. Later
+                # segments of the run left behind by a crash are recognised on load by their seqs.
+                self.write_index(target, index)
+                replace(temp_path, target)
+                for number in run[1:]:
+                    self.discard(self.segments[number][0])
+                self.segments[first:last + 1] = [(target, index)]
+                self.locations = [location for number, _ in enumerate(self.segments) for location in self.locations_of(number)]
+            merged += len(run) - 1
+        return merged
+
+    def locations_of(self, number: int) -> List[Tuple[int, int]]:
+        return [(number, offset) for offset in self.segments[number][1].offsets]
+
+
+_payment_log: Optional[PaymentLog] = None
+
+
+def get_payment_log() -> PaymentLog:
+    global _payment_log
+    if _payment_log is None:
+        _payment_log = PaymentLog(
+            getenv("PAYMENT_LOG_PATH", "payment_log"),
+            int(getenv("PAYMENT_LOG_SEGMENT_SIZE", 4 * 1024 * 1024))
+        )
+    return _payment_log
@@ -0,0 +1,260 @@
+from contextlib import contextmanager
+from copy import deepcopy
+from json import load, dump
+from os import getenv, getpid, kill, path, makedirs, replace, stat
+from tempfile import NamedTemporaryFile
+from threading import RLock
+from time import time
+import socket
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from dotenv import load_dotenv
+
+try:
+    import fcntl
+except ImportError:  # Windows has no fcntl; fall back to the in-process lock only
+    fcntl = None  # type: ignore
+
+load_dotenv()
+
+DEFAULT_REGISTRY: Dict[str, Any] = {
+    "config": {
+        "start_port": 8000,
+        "leases": {}
+    },
+    "agents": {},
+    "items": ["wearable", "transport", "electronic", "furniture"]
+}
+
+PORT_LEASE_GRACE = 60.0
+
+
+def port_in_use(port: int) -> bool:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        try:
+            sock.bind(("127.0.0.1", port))
+        except OSError:
+            return True
+    return False
+
+
+def port_leases(config: Dict[str, Any]) -> Dict[str, float]:
+    """Active ports, keyed by str(port) for JSON, with the time each was leased.
+
+    Registries written before leases existed list ports in `active_ports`;
+    those are moved over with an expired lease.
+    """
+    leases = config.setdefault("leases", {})
+    for port in config.pop("active_ports", []):
+        leases.setdefault(str(port), 0.0)
+    return leases
+
+
+def take_port(config: Dict[str, Any]) -> int:
+    """Allocates a port from the free-list, or past the high-water mark when it is empty."""
+    leases = port_leases(config)
+    if "next_port" not in config:
+        active = {int(port) for port in leases}
+        start = config["start_port"] or 1
+        config["next_port"] = max(active, default=start - 1) + 1
+        config["free_ports"] = [
+            port for port in range(config["next_port"] - 1, start - 1, -1) if port not in active]
+
+    busy = []
+    while True:
+        if config["free_ports"]:
+            port = config["free_ports"].pop()
+        else:
+            port = config["next_port"]
+            config["next_port"] += 1
+        if not port_in_use(port):
+            break
+        busy.append(port)
+
+    # Ports held by other processes go to the far end of the free-list, tried again once the rest are used
+    config["free_ports"][:0] = reversed(busy)
+    leases[str(port)] = time()
+    return port
+
+
+def free_port(config: Dict[str, Any], port: int) -> None:
+    if port_leases(config).pop(str(port), None) is not None:
+        config.setdefault("free_ports", []).append(port)
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+
+class Registry:
+    """In-memory view of the agent registry file.
+
+    Lookups are served from memory and the file is only re-read when its
+    mtime, inode or size changes. Writes take an exclusive `fcntl` lock on a
+    sidecar `.lock` file, re-read the latest contents, and replace the file
+    atomically so concurrent launches never see or produce a partial file.
+    """
+
+    def __init__(self, file_path: str) -> None:
+        self.file_path = file_path
+        self.lock_path = f"{file_path}.lock"
+        self.lock = RLock()
+        self.data: Dict[str, Any] = deepcopy(DEFAULT_REGISTRY)
+        self.version: Optional[Tuple[int, int, int]] = None
+        self.deferred: List[Callable[[Dict[str, Any]], None]] = []
+        self.ensure_file()
+
+    def ensure_file(self) -> None:
+        if path.dirname(self.file_path) and not path.exists(path.dirname(self.file_path)):
+            makedirs(path.dirname(self.file_path), exist_ok=True)
+
+        if path.exists(self.file_path) and not path.isfile(self.file_path):
+            raise ValueError(f"{self.file_path} is not a file")
+
+        with self.lock, self.file_lock():
+            self.load()
+            if self.version is None:
+                self.write()
+
+    def file_version(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            info = stat(self.file_path)
+        except FileNotFoundError:
+            return None
+        return info.st_mtime_ns, info.st_ino, info.st_size
+
+    def load(self) -> None:
+        version = self.file_version()
+        try:
+            with open(self.file_path, 'r') as file:
+                self.data = load(file)
+        except Exception:
+            self.data = deepcopy(DEFAULT_REGISTRY)
+            version = None
+        self.version = version
+
+    def refresh(self) -> None:
+        with self.lock:
+            if self.version is None or self.file_version() != self.version:
+                self.load()
+
+    def write(self) -> None:
+        directory = path.dirname(self.file_path) or "."
+        with NamedTemporaryFile('w', dir=directory, delete=False, suffix=".tmp") as file:
+            dump(self.data, file, indent=4)
+        replace(file.name, self.file_path)
+        self.version = self.file_version()
+
+    @contextmanager
+    def file_lock(self) -> Iterator[None]:
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def update(self) -> Iterator[Dict[str, Any]]:
+        """Yields the latest registry data for mutation and saves it on exit."""
+        with self.lock, self.file_lock():
+            self.load()
+            yield self.data
+            self.write()
+
+    def allocate_port(self) -> int:
+        with self.update() as data:
+            return take_port(data["config"])
+
+    def release_port(self, port: int) -> None:
+        with self.update() as data:
+            free_port(data["config"], port)
+
+    def reclaim_ports(self, grace: float = PORT_LEASE_GRACE) -> List[int]:
+        """Frees ports of agents that died without running their shutdown wrapper.
+
+        A port is reclaimed once its lease is older than `grace` seconds and
+        nothing is bound to it any more; its registry entry is dropped too.
+        """
+        reclaimed = []
+        with self.update() as data:
+            config = data["config"]
+            leases = port_leases(config)
+            for port in [int(port) for port in leases]:
+                if time() - leases[str(port)] < grace or port_in_use(port):
+                    continue
+                free_port(config, port)
+                reclaimed.append(port)
+            for name, agent in list(data["agents"].items()):
+                if agent["port"] in reclaimed:
+                    del data["agents"][name]
+        return reclaimed
+
+    def allocate_node(self, limit: int) -> int:
+        """Leases a node id below `limit` to this process for ID generation.
+
+        Ids held by processes that have exited are handed out again, so
+        restarts never exhaust the space and live processes never share one.
+        """
+        pid = getpid()
+        with self.update() as data:
+            config = data["config"]
+            nodes = config.setdefault("nodes", {})
+            start = config.get("next_node", 0)
+            for offset in range(limit):
+                node = (start + offset) % limit
+                holder = nodes.get(str(node))
+                if holder is None or holder == pid or not process_alive(holder):
+                    nodes[str(node)] = pid
+                    config["next_node"] = (node + 1) % limit
+                    return node
+        raise RuntimeError(f"All {limit} node ids are leased to running processes")
+
+    def defer(self, mutation: Callable[[Dict[str, Any]], None]) -> None:
+        """Queues a mutation to be written with the next `flush`, batching many into one write."""
+        with self.lock:
+            self.deferred.append(mutation)
+
+    def flush(self) -> None:
+        with self.lock:
+            if not self.deferred:
+                return
+            with self.update() as data:
+                for mutation in self.deferred:
+                    mutation(data)
+            self.deferred.clear()
+
+    def read(self) -> Dict[str, Any]:
+        self.refresh()
+        return self.data
+
+    def get_agent(self, name: str) -> Optional[Dict[str, Any]]:
+        return self.read()["agents"].get(name)
+
+    def get_items(self) -> List[str]:
+        return self.read()["items"]
+
+
+_registries: Dict[str, Registry] = {}
+_registries_lock = RLock()
+
+
+def get_registry() -> Registry:
+    file_path = getenv("AGENT_FILE_PATH")
+
+    if not file_path:
+        raise ValueError(
+            "`AGENT_FILE_PATH` is not set in environment variables")
+
+    with _registries_lock:
+        if file_path not in _registries:
+            _registries[file_path] = Registry(file_path)
+        return _registries[file_path]
@@ -0,0 +1,139 @@
+from typing import Any, Callable, Dict, List, Optional
+
+# Collections of a user agent's rental state
+COLLECTIONS = ("items", "requested", "rents", "rented", "handover")
+
+# Position of the rental id in each collection's entries: the rent or return
+# code for requested and rented items, the payment id for rents
+ID_FIELDS = {"requested": 1, "rents": 2, "rented": 1}
+
+# Position of the owner in entries of collections holding other users' items.
+# Listings are only unique per owner, so these are keyed by owner and name;
+# the others hold the user's own items and are keyed by name.
+OWNER_FIELDS = {"requested": 2, "rents": 1}
+
+
+def rental_key(collection: str, name: str, owner: Optional[str] = None) -> str:
+    # Agent addresses contain no ":"; requests stored before owners were recorded have none
+    return f"{owner or ''}:{name}" if collection in OWNER_FIELDS else name
+
+
+def entry_owner(collection: str, entry: Any) -> Optional[str]:
+    field = OWNER_FIELDS.get(collection)
+    return entry[field] if field is not None and len(entry) > field else None
+
+
+def entry_key(collection: str, entry: Any) -> str:
+    name = entry["name"] if collection == "items" else entry[0]["name"]
+    return rental_key(collection, name, entry_owner(collection, entry))
+
+
+class RentalState:
+    """A user agent's items and rentals, indexed by key and rental id.
+
+    All collections live under one `rentals` storage key and are written
+    with row-level `put`/`delete`; a move between collections runs in one
+    storage batch, so it happens completely or not at all. Every change holds
+    the storage lock, so handlers on other threads never see half a move.
+    Lookups, inserts, deletes and moves are O(1).
+    """
+
+    def __init__(self, storage: Any) -> None:
+        self.storage = storage
+        if storage.has("rentals"):
+            self.data: Dict[str, Dict[str, Any]] = storage.get("rentals")
+            self.rekey()
+        else:
+            self.data = self.migrate(storage)
+        self.ids: Dict[str, Dict[str, str]] = {collection: {} for collection in ID_FIELDS}
+        for collection in ID_FIELDS:
+            for key, entry in self.data[collection].items():
+                self.ids[collection][str(entry[ID_FIELDS[collection]])] = key
+
+    def migrate(self, storage: Any) -> Dict[str, Dict[str, Any]]:
+        """Converts the old per-collection lists into the indexed layout."""
+        data: Dict[str, Dict[str, Any]] = {collection: {} for collection in COLLECTIONS}
+        for collection in COLLECTIONS:
+            for entry in (storage.get(collection) if storage.has(collection) else None) or []:
+                data[collection][entry_key(collection, entry)] = entry
+        storage.set("rentals", data)
+        return data
+
+    def rekey(self) -> None:
+        """Moves entries stored under item name alone to their owner and name key."""
+        with self.storage.batch():
+            for collection in OWNER_FIELDS:
+                for key, entry in list(self.data[collection].items()):
+                    if key != entry_key(collection, entry):
+                        del self.data[collection][key]
+                        self.data[collection][entry_key(collection, entry)] = entry
+                        self.storage.delete("rentals", [collection, key])
+                        self.storage.put("rentals", [collection, entry_key(collection, entry)], entry)
+
+    def resolve(self, collection: str, name: str, owner: Optional[str] = None) -> str:
+        key = rental_key(collection, name, owner)
+        if key not in self.data[collection] and owner:
+            # Fall back to a request made before owners were recorded
+            legacy = rental_key(collection, name)
+            if legacy in self.data[collection]:
+                return legacy
+        return key
+
+    def get(self, collection: str, name: str, owner: Optional[str] = None) -> Optional[Any]:
+        return self.data[collection].get(self.resolve(collection, name, owner))
+
+    def find(self, collection: str, rental_id: str) -> Optional[Any]:
+        key = self.ids[collection].get(str(rental_id))
+        return None if key is None else self.data[collection][key]
+
+    def values(self, collection: str) -> List[Any]:
+        return list(self.data[collection].values())
+
+    def add(self, collection: str, entry: Any) -> None:
+        key = entry_key(collection, entry)
+        with self.storage.batch():
+            self.pop(collection, key)
+            self.data[collection][key] = entry
+            self.storage.put("rentals", [collection, key], entry)
+            if collection in ID_FIELDS:
+                self.ids[collection][str(entry[ID_FIELDS[collection]])] = key
+
+    def pop(self, collection: str, key: str) -> Optional[Any]:
+        with self.storage.batch():
+            entry = self.data[collection].pop(key, None)
+            if entry is None:
+                return None
+            self.storage.delete("rentals", [collection, key])
+            if collection in ID_FIELDS:
+                self.ids[collection].pop(str(entry[ID_FIELDS[collection]]), None)
+            return entry
+
+    def remove(self, collection: str, name: str, owner: Optional[str] = None) -> Optional[Any]:
+        return self.pop(collection, self.resolve(collection, name, owner))
+
+    def move(
+        self,
+        source: str,
+        target: str,
+        name: str,
+        convert: Callable[[Any], Any],
+        owner: Optional[str] = None
+    ) -> Optional[Any]:
+        """Moves an entry between collections, reshaped by `convert`, in one write."""
+        with self.storage.batch():
+            entry = self.remove(source, name, owner)
+            if entry is None:
+                return None
+            moved = convert(entry)
+            self.add(target, moved)
+        return moved
+
+
+# Rental state per user agent address
+rental_states: Dict[str, RentalState] = {}
+
+
+def get_rentals(context: Any) -> RentalState:
+    if context.agent.address not in rental_states:
+        rental_states[context.agent.address] = RentalState(context.storage)
+    return rental_states[context.agent.address]
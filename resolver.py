@@ -0,0 +1,41 @@
+from typing import Dict, List, Optional, Tuple
+from uagents.resolver import GlobalResolver, Resolver  # type: ignore
+from registry import get_registry
+
+
+class LocalResolver(Resolver):
+    """Resolves co-located agents from the AGENT_FILE_PATH registry.
+
+    Addresses found in the registry map straight to their local `/submit`
+    endpoint; anything else falls back to the almanac/name service lookup.
+    The address map is rebuilt only when the registry file changes.
+    """
+
+    def __init__(self, fallback: Optional[Resolver] = None) -> None:
+        self.fallback = fallback or GlobalResolver()
+        self.endpoints: Dict[str, str] = {}
+        self.version: Optional[Tuple[int, int, int]] = None
+
+    def load(self) -> Dict[str, str]:
+        registry = get_registry()
+        agents = registry.read()["agents"]
+
+        if registry.version is None or registry.version != self.version:
+            self.endpoints = {
+                agent["agent_address"]: f"http://127.0.0.1:{agent["port"]}/submit"
+                for agent in agents.values()
+                if agent.get("agent_address")
+            }
+            self.version = registry.version
+
+        return self.endpoints
+
+    async def resolve(self, destination: str) -> Tuple[Optional[str], List[str]]:
+        address = destination.split("/")[-1]
+        endpoint = self.load().get(address)
+        if endpoint:
+            return address, [endpoint]
+        return await self.fallback.resolve(destination)
+
+
+local_resolver = LocalResolver()
@@ -0,0 +1,92 @@
+from heapq import heapify, heappop, heappush
+from time import perf_counter
+from typing import Any, Dict, Iterator, List, Tuple
+
+# Payment `repeat` values count check_payments ticks, which run once a minute
+TICK_SECONDS = 60
+
+
+class PaymentScheduler:
+    """Min-heap of recurring payments keyed by their next due time.
+
+    Each tick only pops the payments that are due, so its cost depends on how
+    many payments are due rather than how many exist. Entries are removed
+    lazily: a popped entry whose payment was cancelled or rescheduled since
+    is skipped.
+    """
+
+    def __init__(self) -> None:
+        self.heap: List[Tuple[float, Any]] = []
+        self.loaded = False
+
+    def load(self, payments: Dict[Any, Dict[str, Any]], now: float) -> None:
+        for payment in payments.values():
+            payment.setdefault("next_due", now)
+        self.heap = [(payment["next_due"], payment_id)
+                     for payment_id, payment in payments.items()]
+        heapify(self.heap)
+        self.loaded = True
+
+    def schedule(self, payment_id: Any, due: float) -> None:
+        heappush(self.heap, (due, payment_id))
+
+    def reschedule(self, payment_id: Any, payment: Dict[str, Any], now: float) -> None:
+        period = max(payment["repeat"], 1) * TICK_SECONDS
+        # After downtime, bill once and resume the cycle instead of catching up tick by tick
+        payment["next_due"] += period
+        if payment["next_due"] <= now:
+            payment["next_due"] = now + period
+        self.schedule(payment_id, payment["next_due"])
+
+    def retry(self, payment_id: Any, payment: Dict[str, Any], now: float) -> None:
+        payment["next_due"] = now + TICK_SECONDS
+        self.schedule(payment_id, payment["next_due"])
+
+    def due(self, payments: Dict[Any, Dict[str, Any]], now: float) -> Iterator[Tuple[Any, Dict[str, Any]]]:
+        while self.heap and self.heap[0][0] <= now:
+            due, payment_id = heappop(self.heap)
+            payment = payments.get(payment_id)
+            if payment is None or payment.get("next_due") != due:
+                continue
+            yield payment_id, payment
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+
+class PaymentMetrics:
+    """Timing and throughput of the most recent billing cycle, plus running totals."""
+
+    def __init__(self) -> None:
+        self.cycle_start = 0.0
+        self.cycle_duration = 0.0
+        self.due = 0
+        self.settled = 0
+        self.failed = 0
+        self.total_settled = 0
+        self.total_failed = 0
+
+    def start(self, due: int) -> None:
+        self.cycle_start = perf_counter()
+        self.due = due
+        self.settled = 0
+        self.failed = 0
+
+    def record(self, settled: bool) -> None:
+        if settled:
+            self.settled += 1
+            self.total_settled += 1
+        else:
+            self.failed += 1
+            self.total_failed += 1
+
+    def finish(self) -> None:
+        self.cycle_duration = perf_counter() - self.cycle_start
+
+    @property
+    def settled_per_second(self) -> float:
+        return self.settled / self.cycle_duration if self.cycle_duration else 0.0
+
+    def summary(self) -> str:
+        return (f"Billing cycle: {self.due} due, {self.settled} settled, {self.failed} failed "
+                f"in {self.cycle_duration:.2f}s ({self.settled_per_second:.1f} payments/s)")
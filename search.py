@@ -0,0 +1,311 @@
+from collections import Counter, OrderedDict
+from hashlib import sha1
+from heapq import nlargest
+from math import log
+from os import getenv
+from time import monotonic
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple, Type
+from zlib import crc32
+from dotenv import load_dotenv
+import asyncio
+import numpy as np
+import re
+
+load_dotenv()
+
+# Listings handed to the LLM per search, or returned directly in vector mode
+SEARCH_TOP_K = int(getenv("SEARCH_TOP_K", 20))
+# "llm" asks the chain to pick from BM25 candidates, "vector" answers from the TF-IDF index alone
+SEARCH_MODE = getenv("SEARCH_MODE", "llm")
+# Width of the hashed TF-IDF vectors; memory is 4 bytes per dimension per listing.
+# Narrower vectors search faster but hash collisions drown out typo matches.
+VECTOR_DIMENSIONS = int(getenv("VECTOR_DIMENSIONS", 1024))
+# Search answers kept per city, and for how many seconds; 0 entries disables the cache
+SEARCH_CACHE_SIZE = int(getenv("SEARCH_CACHE_SIZE", 1024))
+SEARCH_CACHE_TTL = float(getenv("SEARCH_CACHE_TTL", 300))
+# LLM calls a city runs at once, and seconds a search may take, waiting for a slot included
+SEARCH_CONCURRENCY = int(getenv("SEARCH_CONCURRENCY", 4))
+SEARCH_TIMEOUT = float(getenv("SEARCH_TIMEOUT", 30))
+
+TOKEN = re.compile(r"\w+")
+
+# (owner, item name)
+DocId = Tuple[str, str]
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN.findall(text.lower())
+
+
+def item_text(item: Dict[str, Any]) -> str:
+    return f"{item['name']} {item.get('description', '')}"
+
+
+class BM25Index:
+    """Incremental BM25 inverted index over one category's item names and descriptions.
+
+    Adding or removing a listing only touches the postings of its own
+    terms; document frequencies and the average length are kept as running
+    totals, so the index never needs a rebuild.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75) -> None:
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[DocId, int]] = {}
+        self.terms: Dict[DocId, Counter] = {}
+        self.lengths: Dict[DocId, int] = {}
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    def add(self, doc: DocId, text: str) -> None:
+        self.remove(doc)
+        terms = Counter(tokenize(text))
+        self.terms[doc] = terms
+        self.lengths[doc] = sum(terms.values())
+        self.total_length += self.lengths[doc]
+        for term, count in terms.items():
+            self.postings.setdefault(term, {})[doc] = count
+
+    def remove(self, doc: DocId) -> None:
+        terms = self.terms.pop(doc, None)
+        if terms is None:
+            return
+        self.total_length -= self.lengths.pop(doc)
+        for term in terms:
+            postings = self.postings[term]
+            del postings[doc]
+            if not postings:
+                del self.postings[term]
+
+    def top_k(self, query: str, k: int) -> List[Tuple[DocId, float]]:
+        if not self.terms:
+            return []
+        count = len(self.terms)
+        average_length = self.total_length / count or 1
+        scores: Dict[DocId, float] = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = log((count - len(postings) + 0.5) / (len(postings) + 0.5) + 1)
+            for doc, frequency in postings.items():
+                scores[doc] = scores.get(doc, 0.0) + idf * frequency * (self.k1 + 1) / (
+                    frequency + self.k1 * (1 - self.b + self.b * self.lengths[doc] / average_length))
+        return nlargest(k, scores.items(), key=lambda score: score[1])
+
+
+class VectorIndex:
+    """Hashed n-gram TF-IDF vectors for one category, searched by cosine similarity.
+
+    Words and their character trigrams are hashed into `dimensions` signed
+    buckets, so no vocabulary or model download is needed and a typo still
+    shares most trigrams with the listing. Rows hold L2-normalised term
+    frequencies and IDF weights are applied to the query side only, so
+    adding or removing a listing writes a single row and never reweights
+    the others. Deleted rows are zeroed and reused.
+    """
+
+    def __init__(self, dimensions: int = VECTOR_DIMENSIONS) -> None:
+        self.dimensions = dimensions
+        self.vectors = np.zeros((64, dimensions), dtype=np.float32)
+        self.frequencies = np.zeros(dimensions, dtype=np.int64)
+        self.docs: List[Any] = []
+        self.rows: Dict[DocId, int] = {}
+        self.free: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def features(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        grams = []
+        for word in tokenize(text):
+            grams.append(word)
+            padded = f"#{word}#"
+            grams.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+        hashes = np.array([crc32(gram.encode()) for gram in grams], dtype=np.uint32)
+        return hashes % self.dimensions, np.where(hashes & 0x80000000, -1.0, 1.0)
+
+    def embed(self, text: str) -> np.ndarray:
+        buckets, signs = self.features(text)
+        vector = np.bincount(buckets, weights=signs, minlength=self.dimensions).astype(np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def add(self, doc: DocId, text: str) -> None:
+        self.remove(doc)
+        if self.free:
+            row = self.free.pop()
+            self.docs[row] = doc
+        else:
+            row = len(self.docs)
+            if row == len(self.vectors):
+                self.vectors = np.concatenate([self.vectors, np.zeros_like(self.vectors)])
+            self.docs.append(doc)
+        self.rows[doc] = row
+        self.vectors[row] = self.embed(text)
+        self.frequencies[np.nonzero(self.vectors[row])] += 1
+
+    def remove(self, doc: DocId) -> None:
+        row = self.rows.pop(doc, None)
+        if row is None:
+            return
+        self.frequencies[np.nonzero(self.vectors[row])] -= 1
+        self.vectors[row] = 0
+        self.docs[row] = None
+        self.free.append(row)
+
+    def queries(self, queries: List[str]) -> np.ndarray:
+        idf = np.log((len(self.rows) + 1) / (self.frequencies + 1)).astype(np.float32) + 1
+        matrix = np.stack([self.embed(query) for query in queries]) * idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms, norms, 1)
+
+    def top_k_batch(self, queries: List[str], k: int) -> List[List[Tuple[DocId, float]]]:
+        """Best `k` listings for each query, scored with one matrix product for the whole batch."""
+        count = len(self.docs)
+        if not self.rows or not queries:
+            return [[] for _ in queries]
+        scores = self.queries(queries) @ self.vectors[:count].T
+        if self.free:
+            scores[:, self.free] = -np.inf
+        k = min(k, len(self.rows))
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for query_scores, rows in zip(scores, top):
+            rows = rows[np.argsort(-query_scores[rows])]
+            results.append([(self.docs[row], float(query_scores[row])) for row in rows if query_scores[row] > 0])
+        return results
+
+    def top_k(self, query: str, k: int) -> List[Tuple[DocId, float]]:
+        return self.top_k_batch([query], k)[0]
+
+
+class CatalogSearch:
+    """Per-category search indexes, BM25 or vector, kept in step with a CityCatalog."""
+
+    def __init__(self, catalog: Any, index: Type = BM25Index) -> None:
+        self.catalog = catalog
+        self.index = index
+        self.indexes: Dict[str, Any] = {}
+        for category, owners in catalog.items.items():
+            for owner, listings in owners.items():
+                for item in listings.values():
+                    self.added(category, owner, item)
+        catalog.observers.append(self)
+
+    def added(self, category: str, owner: str, item: Dict[str, Any]) -> None:
+        if category not in self.indexes:
+            self.indexes[category] = self.index()
+        self.indexes[category].add((owner, item["name"]), item_text(item))
+
+    def deleted(self, category: str, owner: str, name: str) -> None:
+        if category in self.indexes:
+            self.indexes[category].remove((owner, name))
+
+    def ranked(self, category: str, query: str, k: int = SEARCH_TOP_K) -> List[Tuple[str, Dict[str, Any]]]:
+        """The `k` best matching listings as `(owner, item)`, best first.
+
+        Queries with no matching terms ("what can I rent?") get the first `k`
+        listings instead, so there is still something to answer from.
+        """
+        listings = self.catalog.category(category)
+        index = self.indexes.get(category)
+        docs = [doc for doc, _ in index.top_k(query, k)] if index else []
+        if not docs:
+            docs = [(owner, name) for owner, items in listings.items() for name in items][:k]
+        return [(owner, listings[owner][name]) for owner, name in docs if name in listings.get(owner, {})]
+
+    def candidates(self, category: str, query: str, k: int = SEARCH_TOP_K) -> Dict[str, Dict[str, Any]]:
+        """`ranked` grouped as `{owner: {name: item}}`, like a catalog category."""
+        selected: Dict[str, Dict[str, Any]] = {}
+        for owner, item in self.ranked(category, query, k):
+            selected.setdefault(owner, {})[item["name"]] = item
+        return selected
+
+
+async def invoke_chain(chain: Any, inputs: Dict[str, Any], limit: asyncio.Semaphore,
+                       timeout: float = SEARCH_TIMEOUT) -> Any:
+    """Awaits `chain.ainvoke` so the agent's event loop keeps serving other messages meanwhile.
+
+    At most `limit` calls run at once; `asyncio.TimeoutError` is raised when
+    the call, queueing included, takes longer than `timeout` seconds.
+    """
+    async def run() -> Any:
+        async with limit:
+            return await chain.ainvoke(inputs)
+    return await asyncio.wait_for(run(), timeout)
+
+
+def search_key(category: str, query: str, history: str, version: int) -> Tuple[str, str, str, int]:
+    """Cache key for a search: case, punctuation and spacing of the query do not matter."""
+    return category, " ".join(tokenize(query)), sha1(history.encode()).hexdigest(), version
+
+
+class SearchCache:
+    """LRU cache of search answers whose entries also expire after `ttl` seconds.
+
+    Keys carry the category's catalog version, so an add or delete makes
+    every older answer for that category unreachable; they age out of the
+    LRU order instead of being purged. Each entry remembers how long it
+    took to compute, which every hit adds to `saved`.
+    """
+
+    def __init__(self, size: int = SEARCH_CACHE_SIZE, ttl: float = SEARCH_CACHE_TTL) -> None:
+        self.size = size
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0.0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if entry is None or monotonic() - entry[1] > self.ttl:
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        self.saved += entry[2]
+        return entry[0]
+
+    def put(self, key: Hashable, value: Any, elapsed: float) -> None:
+        if self.size <= 0:
+            return
+        self.entries[key] = (value, monotonic(), elapsed)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses ({self.hit_rate:.0%}), {self.saved:.1f}s of search time saved"
+
+
+class SingleFlight:
+    """Runs one call per key at a time; callers arriving while it is pending await its result.
+
+    The call runs as its own task, so a caller that is cancelled or times
+    out does not cancel it for the others.
+    """
+
+    def __init__(self) -> None:
+        self.calls: Dict[Hashable, asyncio.Future] = {}
+        self.shared = 0
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable[Any]]) -> Any:
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(call())
+            self.calls[key] = task
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
@@ -0,0 +1,452 @@
+from contextlib import contextmanager
+from os import fsync, getcwd, getenv, path, replace, remove as remove_file
+from threading import RLock
+from time import time
+from typing import Any, Callable, Dict, Iterator, Optional, Sequence, Tuple
+from dotenv import load_dotenv
+from env import env_flag
+from uagents.storage import KeyValueStore, StorageAPI  # type: ignore
+import json
+import sqlite3
+
+load_dotenv()
+
+# Separates the components of a nested key in SQLite row paths
+SEPARATOR = "\x1f"
+
+# Opt-in write-behind caching of hot storage keys
+WRITE_BEHIND = env_flag("WRITE_BEHIND")
+WRITE_BEHIND_KEYS = getenv("WRITE_BEHIND_KEYS", "items,users,payments,requested,rentals").split(",")
+WRITE_BEHIND_MAX_PENDING = int(getenv("WRITE_BEHIND_MAX_PENDING", 256))
+WRITE_BEHIND_MAX_DELAY = float(getenv("WRITE_BEHIND_MAX_DELAY", 1.0))
+WRITE_BEHIND_DURABILITY = getenv("WRITE_BEHIND_DURABILITY", "journal").lower()
+
+
+def assign(root: Dict[str, Any], keys: Sequence[str], value: Any) -> None:
+    for key in keys[:-1]:
+        root = root.setdefault(key, {})
+    root[keys[-1]] = value
+
+
+def discard(root: Dict[str, Any], keys: Sequence[str]) -> Optional[Any]:
+    for key in keys[:-1]:
+        root = root.get(key)  # type: ignore
+        if not isinstance(root, dict):
+            return None
+    return root.pop(keys[-1], None)
+
+
+def lookup(root: Any, keys: Sequence[str]) -> Optional[Any]:
+    for key in keys:
+        if not isinstance(root, dict):
+            return None
+        root = root.get(key)
+    return root
+
+
+class AtomicUpdates:
+    """Read-modify-write primitives shared by the storage engines.
+
+    `update` runs the read, the change and the write under the engine's
+    lock in one batch, so no other writer, thread or task can slip in
+    between.
+    """
+
+    def update(self, key: str, keys: Sequence[str], fn: Callable[[Any], Any]) -> Tuple[Any, Any]:
+        """Replaces `storage[key][keys[0]]...` with `fn(current)` and returns `(current, new)`.
+
+        `current` is None when the entry does not exist, and returning None
+        deletes it. `fn` should build a new value rather than mutate `current`.
+        """
+        keys = [str(k) for k in keys]
+        with self.batch():  # type: ignore
+            current = lookup(self.get(key), keys)  # type: ignore
+            new = fn(current)
+            if new is not None:
+                if keys:
+                    self.put(key, keys, new)  # type: ignore
+                else:
+                    self.set(key, new)  # type: ignore
+            elif current is not None:
+                if keys:
+                    self.delete(key, keys)  # type: ignore
+                else:
+                    self.remove(key)  # type: ignore
+            return current, new
+
+
+class JSONStorage(AtomicUpdates, KeyValueStore):
+    """uagents' JSON file store with the row-level `put`/`delete` surface.
+
+    Each write still rewrites the whole file; it keeps handlers written
+    against `put`/`delete` working when the SQLite engine is not enabled.
+    """
+
+    def __init__(self, name: str, cwd: Optional[str] = None) -> None:
+        super().__init__(name, cwd)
+        self.lock = RLock()
+        self.depth = 0
+        self.dirty = False
+
+    def _save(self) -> None:
+        if self.depth:
+            self.dirty = True
+        else:
+            super()._save()
+
+    def put(self, key: str, keys: Sequence[str], value: Any) -> None:
+        with self.batch():
+            assign(self._data.setdefault(key, {}), [str(k) for k in keys], value)
+            self._save()
+
+    def delete(self, key: str, keys: Sequence[str]) -> Optional[Any]:
+        with self.batch():
+            value = discard(self._data.get(key) or {}, [str(k) for k in keys])
+            self._save()
+            return value
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """Groups writes so the file is rewritten once at the end."""
+        with self.lock:
+            self.depth += 1
+            try:
+                yield
+            finally:
+                self.depth -= 1
+                if not self.depth and self.dirty:
+                    self.dirty = False
+                    super()._save()
+
+
+class SQLiteStorage(AtomicUpdates, StorageAPI):
+    """Agent storage backed by SQLite in WAL mode, with row-level writes.
+
+    Every dict is exploded into rows of `(key, path, value)`: one row per
+    nested dict and one JSON-encoded row per other value. `put` and `delete`
+    only touch the rows under the given nested key, so adding an item costs
+    O(item) rather than O(catalog). Reads are served from an in-memory copy
+    loaded once at startup.
+    """
+
+    def __init__(self, file_path: str, legacy_path: Optional[str] = None) -> None:
+        self.file_path = file_path
+        self.lock = RLock()
+        self.depth = 0
+        self.connection = sqlite3.connect(file_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS rows (key TEXT, path TEXT, value TEXT, PRIMARY KEY (key, path)) WITHOUT ROWID")
+        self._data = self.load()
+
+        if not self._data and legacy_path and path.isfile(legacy_path):
+            self.migrate(legacy_path)
+
+    def load(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = {}
+        rows = self.connection.execute("SELECT key, path, value FROM rows ORDER BY key, path")
+        for key, row_path, value in rows:
+            value = {} if value is None else json.loads(value)
+            if row_path:
+                assign(data.setdefault(key, {}), row_path.split(SEPARATOR), value)
+            else:
+                data[key] = value
+        return data
+
+    def migrate(self, legacy_path: str) -> None:
+        """Imports a uagents JSON storage file and moves it aside."""
+        with open(legacy_path, 'r') as file:
+            legacy = json.load(file)
+        with self.batch():
+            for key, value in legacy.items():
+                self.set(key, value)
+        replace(legacy_path, f"{legacy_path}.migrated")
+
+    def rows(self, key: str, row_path: str, value: Any) -> Iterator[Tuple[str, str, Optional[str]]]:
+        if isinstance(value, dict):
+            yield key, row_path, None
+            for child, child_value in value.items():
+                yield from self.rows(key, f"{row_path}{SEPARATOR}{child}" if row_path else str(child), child_value)
+        else:
+            yield key, row_path, json.dumps(value)
+
+    def delete_rows(self, key: str, row_path: str) -> None:
+        if not row_path:
+            self.connection.execute("DELETE FROM rows WHERE key = ?", (key,))
+            return
+        # The path and its descendants ("<path>\x1f...") all sort before "<path>\x20",
+        # so one primary key range covers them
+        self.connection.execute(
+            "DELETE FROM rows WHERE key = ? AND path >= ? AND path < ?",
+            (key, row_path, row_path + chr(ord(SEPARATOR) + 1)))
+
+    def write_rows(self, key: str, row_path: str, value: Any) -> None:
+        self.delete_rows(key, row_path)
+        self.connection.executemany(
+            "INSERT INTO rows (key, path, value) VALUES (?, ?, ?)", self.rows(key, row_path, value))
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """Runs the writes inside it as one transaction."""
+        with self.lock:
+            if not self.depth:
+                self.connection.execute("BEGIN IMMEDIATE")
+            self.depth += 1
+            try:
+                yield
+            except BaseException:
+                self.depth -= 1
+                if not self.depth:
+                    self.connection.execute("ROLLBACK")
+                    self._data = self.load()
+                raise
+            self.depth -= 1
+            if not self.depth:
+                self.connection.execute("COMMIT")
+
+    def get(self, key: str) -> Optional[Any]:
+        return self._data.get(key)
+
+    def has(self, key: str) -> bool:
+        return key in self._data
+
+    def set(self, key: str, value: Any) -> None:
+        with self.batch():
+            self.write_rows(key, "", value)
+            self._data[key] = value
+
+    def remove(self, key: str) -> None:
+        with self.batch():
+            self.delete_rows(key, "")
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self.batch():
+            self.connection.execute("DELETE FROM rows")
+            self._data.clear()
+
+    def put(self, key: str, keys: Sequence[str], value: Any) -> None:
+        """Sets `storage[key][keys[0]][keys[1]]...` to `value`, creating missing dicts."""
+        keys = [str(k) for k in keys]
+        with self.batch():
+            if not isinstance(self._data.get(key), dict):
+                self.write_rows(key, "", {})
+                self._data[key] = {}
+            # Ancestors are dicts, which are rows with a NULL value
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO rows (key, path, value) VALUES (?, ?, NULL)",
+                [(key, SEPARATOR.join(keys[:depth])) for depth in range(1, len(keys))])
+            self.write_rows(key, SEPARATOR.join(keys), value)
+            assign(self._data[key], keys, value)
+
+    def delete(self, key: str, keys: Sequence[str]) -> Optional[Any]:
+        """Removes `storage[key][keys[0]]...` and returns it, or None if it was not there."""
+        keys = [str(k) for k in keys]
+        with self.batch():
+            value = discard(self._data.get(key) or {}, keys)
+            self.delete_rows(key, SEPARATOR.join(keys))
+            return value
+
+
+class WriteBehindStorage(AtomicUpdates, StorageAPI):
+    """Keeps hot keys in memory and writes their changes to `inner` in coalesced batches.
+
+    Mutations of hot keys are recorded per nested key, so ten puts to one
+    payment become one write, and are flushed in one `inner.batch()` once
+    `max_pending` changes are queued, `max_delay` seconds have passed (see
+    `due`), or on `flush()` at shutdown. `durability` sets what survives a
+    crash between flushes:
+
+    - "none": nothing; queued changes are lost.
+    - "journal": changes are appended to a journal file first and replayed
+      on the next start, so they survive the process dying.
+    - "fsync": as "journal", but each append is fsynced, so changes also
+      survive the machine losing power.
+    """
+
+    def __init__(
+        self,
+        inner: Any,
+        hot_keys: Sequence[str],
+        journal_path: str,
+        max_pending: int = 256,
+        max_delay: float = 1.0,
+        durability: str = "journal"
+    ) -> None:
+        if durability not in ("none", "journal", "fsync"):
+            raise ValueError(f"Unknown durability {durability!r}")
+        self.inner = inner
+        self.hot_keys = set(hot_keys)
+        self.journal_path = journal_path
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        self.durability = durability
+        self.lock = RLock()
+        self.depth = 0
+        self.values: Dict[str, Any] = {}
+        self.pending: Dict[Tuple[str, Tuple[str, ...]], Tuple[str, Any]] = {}
+        self.oldest: Optional[float] = None
+        self.journal = None
+        self.recover()
+        if durability != "none":
+            self.journal = open(journal_path, 'a')
+
+    def recover(self) -> None:
+        """Applies changes journaled before a crash, then starts a fresh journal."""
+        if not path.isfile(self.journal_path):
+            return
+        with open(self.journal_path, 'r') as file:
+            entries = []
+            for line in file:
+                if not line.endswith("\n"):
+                    break
+                entries.append(json.loads(line))
+        with self.inner.batch():
+            for op, key, keys, value in entries:
+                self.apply(op, key, keys, value)
+        remove_file(self.journal_path)
+
+    def apply(self, op: str, key: str, keys: Sequence[str], value: Any) -> None:
+        if op == "set":
+            self.inner.set(key, value)
+        elif op == "remove":
+            self.inner.remove(key)
+        elif op == "put":
+            self.inner.put(key, keys, value)
+        else:
+            self.inner.delete(key, keys)
+
+    def value(self, key: str) -> Any:
+        if key not in self.values:
+            self.values[key] = self.inner.get(key) if self.inner.has(key) else None
+        return self.values[key]
+
+    def record(self, op: str, key: str, keys: Sequence[str], value: Any = None) -> None:
+        keys = tuple(keys)
+        if self.journal:
+            self.journal.write(json.dumps([op, key, keys, value]) + "\n")
+            self.journal.flush()
+            if self.durability == "fsync":
+                fsync(self.journal.fileno())
+        # Drop queued changes this one overwrites: its own nested key and everything under it
+        for pending in [pending for pending in self.pending
+                        if pending[0] == key and pending[1][:len(keys)] == keys]:
+            del self.pending[pending]
+        self.pending[(key, keys)] = (op, value)
+        if self.oldest is None:
+            self.oldest = time()
+        if not self.depth and len(self.pending) >= self.max_pending:
+            self.flush()
+
+    def due(self) -> bool:
+        return self.oldest is not None and time() - self.oldest >= self.max_delay
+
+    def flush(self) -> None:
+        with self.lock:
+            if not self.pending:
+                return
+            with self.inner.batch():
+                for (key, keys), (op, value) in self.pending.items():
+                    self.apply(op, key, keys, value)
+            self.pending.clear()
+            self.oldest = None
+            if self.journal:
+                self.journal.truncate(0)
+                self.journal.seek(0)
+
+    def close(self) -> None:
+        self.flush()
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+            remove_file(self.journal_path)
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        with self.lock:
+            self.depth += 1
+            try:
+                yield
+            finally:
+                self.depth -= 1
+            if not self.depth and len(self.pending) >= self.max_pending:
+                self.flush()
+
+    def get(self, key: str) -> Optional[Any]:
+        if key in self.hot_keys:
+            return self.value(key)
+        return self.inner.get(key)
+
+    def has(self, key: str) -> bool:
+        if key in self.hot_keys:
+            return self.value(key) is not None
+        return self.inner.has(key)
+
+    def set(self, key: str, value: Any) -> None:
+        if key not in self.hot_keys:
+            return self.inner.set(key, value)
+        with self.lock:
+            self.values[key] = value
+            self.record("set", key, (), value)
+
+    def remove(self, key: str) -> None:
+        if key not in self.hot_keys:
+            return self.inner.remove(key)
+        with self.lock:
+            self.values[key] = None
+            self.record("remove", key, ())
+
+    def clear(self) -> None:
+        with self.lock:
+            self.pending.clear()
+            self.values.clear()
+            if self.journal:
+                self.journal.truncate(0)
+                self.journal.seek(0)
+            self.inner.clear()
+
+    def put(self, key: str, keys: Sequence[str], value: Any) -> None:
+        if key not in self.hot_keys:
+            return self.inner.put(key, keys, value)
+        keys = [str(k) for k in keys]
+        with self.lock:
+            if not isinstance(self.value(key), dict):
+                self.values[key] = {}
+                self.record("set", key, (), {})
+            assign(self.values[key], keys, value)
+            self.record("put", key, keys, value)
+
+    def delete(self, key: str, keys: Sequence[str]) -> Optional[Any]:
+        if key not in self.hot_keys:
+            return self.inner.delete(key, keys)
+        keys = [str(k) for k in keys]
+        with self.lock:
+            removed = discard(self.value(key) or {}, keys)
+            self.record("delete", key, keys)
+            return removed
+
+
+def create_storage(name: str, cwd: Optional[str] = None) -> Any:
+    """Builds the store selected by `STORAGE_BACKEND` ("json", the default, or "sqlite").
+
+    With `WRITE_BEHIND` set, the hot keys in `WRITE_BEHIND_KEYS` are cached
+    and flushed in batches; see WriteBehindStorage.
+    """
+    cwd = cwd or getcwd()
+    legacy_path = path.join(cwd, f"{name}_data.json")
+    if getenv("STORAGE_BACKEND", "json").lower() == "sqlite":
+        storage = SQLiteStorage(path.join(cwd, f"{name}_data.db"), legacy_path)
+    else:
+        storage = JSONStorage(name, cwd)
+
+    if WRITE_BEHIND:
+        return WriteBehindStorage(
+            storage,
+            WRITE_BEHIND_KEYS,
+            path.join(cwd, f"{name}_journal.jsonl"),
+            max_pending=WRITE_BEHIND_MAX_PENDING,
+            max_delay=WRITE_BEHIND_MAX_DELAY,
+            durability=WRITE_BEHIND_DURABILITY
+        )
+    return storage
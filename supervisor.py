@@ -0,0 +1,180 @@
+from json import load
+from multiprocessing import Process
+from os import cpu_count, getenv
+from time import sleep, time
+from typing import Any, Dict, List, Optional
+from dotenv import load_dotenv
+from registry import get_registry, port_in_use
+from utils import get_agents, remove_agent
+from bureau import UserEntry, create_bureau, user_code
+import sys
+
+load_dotenv()
+
+# Seconds before a crashed worker is restarted, doubling with each crash up to the cap
+RESTART_BACKOFF = float(getenv("RESTART_BACKOFF", 1))
+RESTART_BACKOFF_MAX = float(getenv("RESTART_BACKOFF_MAX", 60))
+
+
+def load_fleet(file_path: str) -> Dict[str, Any]:
+    with open(file_path, 'r') as file:
+        fleet = load(file)
+    fleet.setdefault("central", True)
+    fleet.setdefault("cities", [])
+    fleet.setdefault("users", [])
+    return fleet
+
+
+def run_central() -> None:
+    from central import central_agent
+    central_agent.run()
+
+
+def run_shard(cities: List[str], users: List[UserEntry], central_agent_address: str) -> None:
+    create_bureau(cities, users, central_agent_address).run()
+
+
+class Worker:
+    def __init__(self, name: str, agents: List[str], target: Any, args: tuple = ()) -> None:
+        self.name = name
+        self.agents = agents
+        self.target = target
+        self.args = args
+        self.process: Optional[Process] = None
+        self.restarts = 0
+        self.started = 0.0
+        self.restart_at: Optional[float] = None
+
+    def start(self) -> None:
+        self.started = time()
+        self.process = Process(target=self.target, args=self.args, name=self.name, daemon=False)
+        self.process.start()
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def stop(self) -> None:
+        if self.alive():
+            self.process.terminate()  # type: ignore
+        if self.process:
+            self.process.join()
+
+    def release(self) -> None:
+        """Drops the worker's agents from the registry, which frees their ports."""
+        for name in self.agents:
+            try:
+                remove_agent(name)
+            except ValueError:
+                pass
+
+
+class Supervisor:
+    """Shards a fleet of agents across one Bureau process per core.
+
+    The central agent runs in its own process; cities and users are spread
+    round-robin over the remaining workers. Crashed workers have their
+    registry entries released and are restarted with exponential backoff.
+    """
+
+    def __init__(self, fleet: Dict[str, Any], workers: Optional[int] = None, poll_interval: float = 1.0) -> None:
+        self.fleet = fleet
+        self.workers = workers or fleet.get("workers") or cpu_count() or 1
+        self.poll_interval = poll_interval
+        self.central: Optional[Worker] = None
+        self.shards: List[Worker] = []
+
+    def wait_for_central(self, timeout: float = 60.0) -> str:
+        deadline = time() + timeout
+        while time() < deadline:
+            if self.central and not self.central.alive():
+                raise RuntimeError(f"Central agent exited with code {self.central.process.exitcode}")  # type: ignore
+            try:
+                central = get_agents("central_agent")
+                # A run that crashed or was killed leaves its entry behind; only a bound port means it is up
+                if central.agent_address and port_in_use(central.port):
+                    return central.agent_address
+            except ValueError:
+                pass
+            sleep(0.5)
+        raise TimeoutError("Central agent did not register in time")
+
+    def plan(self, central_agent_address: str) -> List[Worker]:
+        agents = [("city", city) for city in self.fleet["cities"]] + \
+            [("user", user) for user in self.fleet["users"]]
+        count = max(1, min(self.workers, len(agents)))
+
+        shards: List[Worker] = []
+        for index in range(count):
+            assigned = agents[index::count]
+            cities = [agent for kind, agent in assigned if kind == "city"]
+            users = [agent for kind, agent in assigned if kind == "user"]
+            shards.append(Worker(
+                f"shard-{index}",
+                cities + [user_code(user) for user in users],
+                run_shard,
+                (cities, users, central_agent_address)
+            ))
+        return shards
+
+    def start(self) -> None:
+        if self.fleet["central"]:
+            print("Starting central agent...")
+            self.central = Worker("central", ["central_agent"], run_central)
+            self.central.start()
+
+        central_agent_address = self.wait_for_central()
+
+        self.shards = self.plan(central_agent_address)
+        for shard in self.shards:
+            print(f"Starting {shard.name} with {len(shard.agents)} agents...")
+            shard.start()
+
+    def workers_list(self) -> List[Worker]:
+        return ([self.central] if self.central else []) + self.shards
+
+    def restart(self, worker: Worker) -> None:
+        """Cleans up after a crashed worker, then starts it again once its backoff has passed."""
+        now = time()
+        if worker.restart_at is None:
+            worker.stop()
+            worker.release()
+            get_registry().reclaim_ports()
+            # A worker that stayed up longer than the longest backoff starts over from the shortest
+            if now - worker.started > RESTART_BACKOFF_MAX:
+                worker.restarts = 0
+            delay = min(RESTART_BACKOFF * 2 ** min(worker.restarts, 16), RESTART_BACKOFF_MAX)
+            worker.restart_at = now + delay
+            print(f"{worker.name} exited with code {worker.process.exitcode}. Restarting in {delay:.0f}s...")  # type: ignore
+        if now < worker.restart_at:
+            return
+        worker.restart_at = None
+        worker.restarts += 1
+        worker.start()
+
+    def run(self) -> None:
+        self.start()
+        try:
+            while True:
+                sleep(self.poll_interval)
+                for worker in self.workers_list():
+                    if not worker.alive():
+                        self.restart(worker)
+        except KeyboardInterrupt:
+            print("Stopping fleet...")
+        finally:
+            self.stop()
+
+    def stop(self) -> None:
+        for worker in reversed(self.workers_list()):
+            worker.stop()
+            worker.release()
+
+
+if __name__ == "__main__":
+    fleet_path = sys.argv[1] if len(sys.argv) > 1 else getenv("FLEET_FILE_PATH")
+
+    if not fleet_path:
+        print("Usage: python supervisor.py <fleet.json> (or set `FLEET_FILE_PATH`)")
+        exit(1)
+
+    Supervisor(load_fleet(fleet_path)).run()
@@ -0,0 +1,330 @@
+from os import getenv
+from time import time
+from typing import Any, Callable, Dict, List, Optional, Type, Union
+from uuid import uuid4
+from dotenv import load_dotenv
+from pydantic import ValidationError
+from uagents import Agent, Context, Model  # type: ignore
+from uagents import communication  # type: ignore
+from uagents.communication import MsgStatus  # type: ignore
+from uagents.context import ERROR_MESSAGE_DIGEST  # type: ignore
+from uagents.crypto import generate_user_address  # type: ignore
+from uagents.envelope import Envelope  # type: ignore
+from uagents.types import DeliveryStatus  # type: ignore
+from resolver import local_resolver
+import aiohttp
+import asyncio
+import json
+
+load_dotenv()
+
+
+class LocalContext:
+    """Context for handlers of agents hosted on the local bus.
+
+    Sends to query waiters or to other agents hosted by the bus hand the Model
+    instance over directly; everything else goes through the wrapped context.
+    Replies are checked against the protocol's `replies` the way uagents
+    checks them, and every send returns a `MsgStatus`.
+    """
+
+    def __init__(self, bus: "LocalBus", context: Context, received: Optional[str] = None) -> None:
+        self._bus = bus
+        self._context = context
+        self._received = received
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._context, name)
+
+    def valid_reply(self, message: Model) -> bool:
+        if self._received is None:
+            return True
+        digest = self._bus.digest(type(message))
+        replies = self._bus.agents[self._context.agent.address]._replies
+        if digest == ERROR_MESSAGE_DIGEST or not replies:
+            return True
+        return digest in replies.get(self._received, {})
+
+    async def send(self, destination: str, message: Model, **kwargs: Any) -> MsgStatus:
+        session = getattr(self._context, "session", None)
+        if not self.valid_reply(message):
+            self._context.logger.error(f"Outgoing message {type(message).__name__} is not a valid reply")
+            return MsgStatus(status=DeliveryStatus.FAILED, detail="Invalid reply",
+                             destination=destination, endpoint="", session=session)
+        if self._bus.reply(destination, message) or (
+                self._bus.hosts(destination) and self._bus.deliver(self._context.agent.address, destination, message)):
+            return MsgStatus(status=DeliveryStatus.DELIVERED, detail="Message delivered over the local bus",
+                             destination=destination, endpoint="", session=session)
+        return await self._context.send(destination, message, **kwargs)
+
+
+class LocalBus:
+    """Delivers Model instances between agents hosted in the same process.
+
+    Each hosted agent gets an in-memory queue drained by one worker task, so
+    its handlers still run one message at a time, as they do behind HTTP.
+    """
+
+    def __init__(self) -> None:
+        self.agents: Dict[str, Agent] = {}
+        self.queues: Dict[str, asyncio.Queue] = {}
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.digests: Dict[Type[Model], str] = {}
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def register(self, agent: Agent) -> None:
+        """Hosts `agent`; call once its protocols are included.
+
+        Its message handlers and its own contexts (startup, shutdown,
+        intervals) are wrapped, so sends take the bus whether a message
+        arrived over HTTP or over the bus itself.
+        """
+        self.agents[agent.address] = agent
+        for handlers in (agent._signed_message_handlers, agent._unsigned_message_handlers):
+            for digest, handler in handlers.items():
+                handlers[digest] = self.wrap(handler, digest)
+        build_context = agent._build_context
+        agent._build_context = lambda: self.context(build_context())
+
+    def wrap(self, handler: Callable, digest: str) -> Callable:
+        async def local_handler(context: Context, sender: str, message: Model) -> None:
+            await handler(self.context(context, digest), sender, message)
+        return local_handler
+
+    def hosts(self, address: str) -> bool:
+        if address not in self.agents:
+            return False
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        return self.loop is None or self.loop is loop
+
+    def context(self, context: Context, received: Optional[str] = None) -> LocalContext:
+        if isinstance(context, LocalContext):
+            context = context._context
+        return LocalContext(self, context, received)
+
+    def digest(self, model: Type[Model]) -> str:
+        if model not in self.digests:
+            self.digests[model] = Model.build_schema_digest(model)
+        return self.digests[model]
+
+    def handler(self, destination: str, message: Model) -> Optional[Callable]:
+        digest = self.digest(type(message))
+        agent = self.agents[destination]
+        return agent._signed_message_handlers.get(digest) or agent._unsigned_message_handlers.get(digest)
+
+    def queue(self, destination: str) -> asyncio.Queue:
+        if destination not in self.queues:
+            self.loop = asyncio.get_running_loop()
+            self.queues[destination] = asyncio.Queue()
+            self.loop.create_task(self.worker(destination))
+        return self.queues[destination]
+
+    async def worker(self, destination: str) -> None:
+        agent = self.agents[destination]
+        queue = self.queues[destination]
+        context = agent._build_context()
+        while True:
+            handler, sender, message = await queue.get()
+            try:
+                await handler(context, sender, message)
+            except Exception as e:
+                context.logger.exception(f"Local handler failed for {type(message).__name__}: {e}")
+
+    def deliver(self, sender: str, destination: str, message: Model) -> bool:
+        handler = self.handler(destination, message)
+        if not handler:
+            return False
+        self.queue(destination).put_nowait((handler, sender, message))
+        return True
+
+    def reply(self, destination: str, message: Model) -> bool:
+        future = self.pending.pop(destination, None)
+        if future is None:
+            return False
+        if not future.done():
+            future.set_result(message)
+        return True
+
+    async def query(self, destination: str, message: Model, timeout: float = 30.0) -> Optional[Model]:
+        sender = generate_user_address()
+        future = asyncio.get_running_loop().create_future()
+        self.pending[sender] = future
+        try:
+            if not self.deliver(sender, destination, message):
+                return None
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.pending.pop(sender, None)
+
+
+local_bus = LocalBus()
+
+
+def verified(envelope: Envelope) -> bool:
+    # verify raises on malformed or forged signatures instead of returning False
+    try:
+        return envelope.verify()
+    except Exception:
+        return False
+
+
+class Transport:
+    """Keep-alive HTTP transport shared by queries and agent sends.
+
+    One `aiohttp.ClientSession` is kept per event loop, and its connector pools
+    up to `pool_size` connections per destination endpoint.
+    """
+
+    def __init__(
+        self,
+        pool_size: Optional[int] = None,
+        keepalive_timeout: Optional[float] = None,
+        pooled: bool = True
+    ) -> None:
+        self.pool_size = pool_size or int(getenv("TRANSPORT_POOL_SIZE", 16))
+        self.keepalive_timeout = keepalive_timeout or float(
+            getenv("TRANSPORT_KEEPALIVE_TIMEOUT", 60))
+        self.pooled = pooled
+        self.resolver = local_resolver
+        self.sessions: Dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+
+    def session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        session = self.sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=0,
+                limit_per_host=self.pool_size,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            session = aiohttp.ClientSession(connector=connector)
+            self.sessions[loop] = session
+        return session
+
+    async def close(self) -> None:
+        session = self.sessions.pop(asyncio.get_running_loop(), None)
+        if session:
+            await session.close()
+
+    async def post(self, endpoint: str, envelope: Envelope, sync: bool = False) -> Any:
+        headers = {"content-type": "application/json"}
+        if sync:
+            headers["x-uagents-connection"] = "sync"
+        data = envelope.model_dump_json()
+
+        if not self.pooled:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(endpoint, headers=headers, data=data) as response:
+                    return response.status, await response.read()
+
+        async with self.session().post(endpoint, headers=headers, data=data) as response:
+            return response.status, await response.read()
+
+    async def send_exchange_envelope(
+        self,
+        envelope: Envelope,
+        endpoints: List[str],
+        sync: bool = False
+    ) -> Union[Envelope, MsgStatus]:
+        errors = []
+        for endpoint in endpoints:
+            try:
+                status, body = await self.post(endpoint, envelope, sync)
+                if status != 200:
+                    errors.append(f"{endpoint} responded with {status}")
+                    continue
+                if sync:
+                    response = Envelope.model_validate_json(body)
+                    if response.signature and not verified(response):
+                        errors.append(f"{endpoint} returned an unverified envelope")
+                        continue
+                    return response
+                return MsgStatus(
+                    status=DeliveryStatus.DELIVERED,
+                    detail="Message successfully delivered via HTTP",
+                    destination=envelope.target,
+                    endpoint=endpoint,
+                    session=envelope.session
+                )
+            except aiohttp.ClientError as e:
+                errors.append(f"{endpoint}: {e}")
+            except asyncio.TimeoutError:
+                errors.append(f"{endpoint} timed out")
+            except ValidationError as e:
+                errors.append(f"{endpoint} returned an invalid envelope: {e}")
+
+        return MsgStatus(
+            status=DeliveryStatus.FAILED,
+            detail=f"Message delivery failed: {errors}",
+            destination=envelope.target,
+            endpoint="",
+            session=envelope.session
+        )
+
+    async def resolve(self, destination: str) -> List[str]:
+        _, endpoints = await self.resolver.resolve(destination)
+        return endpoints
+
+    async def query(self, destination: str, message: Model, timeout: float = 30.0) -> Union[Envelope, MsgStatus]:
+        endpoints = await self.resolve(destination)
+        envelope = Envelope(
+            version=1,
+            sender=generate_user_address(),
+            target=destination,
+            session=uuid4(),
+            schema_digest=Model.build_schema_digest(message),
+            protocol_digest=None,
+            expires=int(time()) + int(timeout)
+        )
+        envelope.encode_payload(message.model_dump_json())
+
+        if not endpoints:
+            return MsgStatus(
+                status=DeliveryStatus.FAILED,
+                detail="Failed to resolve destination address",
+                destination=destination,
+                endpoint="",
+                session=envelope.session
+            )
+
+        try:
+            return await asyncio.wait_for(
+                self.send_exchange_envelope(envelope, endpoints, sync=True), timeout)
+        except asyncio.TimeoutError:
+            return MsgStatus(
+                status=DeliveryStatus.FAILED,
+                detail="Query timed out",
+                destination=destination,
+                endpoint="",
+                session=envelope.session
+            )
+
+    async def query_json(self, destination: str, message: Model, timeout: float = 30.0) -> Optional[Dict[str, Any]]:
+        """Queries `destination` and returns the reply payload, or None on failure.
+
+        Agents hosted in this process are asked over the local bus, skipping
+        the JSON envelope and HTTP round trip entirely.
+        """
+        if local_bus.hosts(destination):
+            reply = await local_bus.query(destination, message, timeout)
+            return reply.model_dump() if reply else None
+
+        data = await self.query(destination, message, timeout)
+        if not isinstance(data, Envelope):
+            return None
+        return json.loads(data.decode_payload())
+
+
+transport = Transport()
+
+
+def install_transport(agent_transport: Optional[Transport] = None) -> Transport:
+    """Route the agents' own `context.send` deliveries through the pooled transport."""
+    agent_transport = agent_transport or transport
+    communication.send_exchange_envelope = agent_transport.send_exchange_envelope
+    return agent_transport
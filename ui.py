@@ -20,6 +20,27 @@ customtkinter.set_appearance_mode("System")
 customtkinter.set_default_color_theme("blue")
 
 
+def run_async(widget, coroutine, callback=None):
+    """Runs `coroutine` on the shared query client and hands its result to
+    `callback` on the Tk thread, so the window stays responsive meanwhile."""
+    future = get_query_client().run(coroutine)
+
+    def poll():
+        if not future.done():
+            widget.after(50, poll)
+            return
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"Query failed: {e}")
+            result = None
+        if callback:
+            callback(result)
+
+    widget.after(50, poll)
+    return future
+
+
 class UserQuery(BaseModel):
     item_category: Literal["wearable", "transport", "electronic", "furniture",
                            "other"] = Field(..., description="The category of the item to query")
@@ -114,13 +135,25 @@ class RentView(customtkinter.CTkFrame):
             row=8, column=1, columnspan=1, padx=10, pady=10)
 
     def rent(self):
-        sync_query(
-            destination=self.id, message=HandOverRequest(item=self.item, agent=self.agent_address))
-        sync_query(
-            destination=self.agent_address, message=RequestedItem(item=self.item))
+        client = get_query_client()
         request = DeleteRequest(
             name=self.item.name, category=self.item.category, agent_address=self.id)
-        sync_query(destination=self.agent_location, message=request)
+        self.rent_button.configure(state="disabled")
+
+        # run_coroutine_threadsafe needs a coroutine, so gather inside one on the client's loop
+        async def rent_all():
+            return await asyncio.gather(
+                client.query(self.id, HandOverRequest(item=self.item, agent=self.agent_address)),
+                client.query(self.agent_address, RequestedItem(item=self.item, owner=self.id)),
+                client.query(self.agent_location, request)
+            )
+
+        run_async(self, rent_all(), self.rent_done)
+
+    def rent_done(self, result):
+        if result is None:
+            self.rent_button.configure(state="normal")
+            return
         print("Item rented successfully")
         self.grid_forget()
         self.reload()
@@ -187,8 +220,10 @@ class ChatCard(customtkinter.CTkFrame):
         self.rent_button.grid(row=4, column=0, columnspan=2, padx=10, pady=10)
 
     def retrive(self):
-        data = sync_query(self.id, ItemRequest(name=self.item.name))
+        run_async(self, get_query_client().query(
+            self.id, ItemRequest(name=self.item.name)), self.show_item)
 
+    def show_item(self, data):
         if not data:
             print("Unable to connect to agent")
             return
@@ -268,38 +303,53 @@ class ChatView(customtkinter.CTkFrame):
 
             self.add_message(message, "outgoing")
 
-            query = self.chain.invoke({"query": message})
+            history = f"Last Query: {
+                self.last_query}\n Last Response: {self.last_response}"
 
-            print(query)
+            async def search():
+                query = await self.chain.ainvoke({"query": message})
 
-            if query["item_category"] == "other":
-                self.add_message(
-                    "Sorry, We don't have this type of item in stock.", "incoming")
-                return
+                print(query)
 
-            # sync_query to the to self.agent_location
+                if query["item_category"] == "other":
+                    return query, None
 
-            history = f"Last Query: {
-                self.last_query}\n Last Response: {self.last_response}"
+                # query to the self.agent_location
 
-            data = sync_query(self.agent_location, SearchRequest(
-                category=query["item_category"], query=message, history=history))
+                data = await get_query_client().query(self.agent_location, SearchRequest(
+                    category=query["item_category"], query=message, history=history))
 
-            print(data)
+                return query, data
 
-            if not data:
-                self.add_message("Unable to connect to location", "incoming")
-                return
+            run_async(self, search(), lambda result: self.receive_message(message, result))
+
+    def receive_message(self, message, result):
+        if not result:
+            self.add_message("Unable to connect to location", "incoming")
+            return
+
+        query, data = result
+
+        if query["item_category"] == "other":
+            self.add_message(
+                "Sorry, We don't have this type of item in stock.", "incoming")
+            return
+
+        print(data)
+
+        if not data:
+            self.add_message("Unable to connect to location", "incoming")
+            return
 
-            self.add_message(data["response"], "incoming")
+        self.add_message(data["response"], "incoming")
 
-            for item in data["items"]:
-                self.add_item(item[0], Item.model_validate(item[1]))
+        for item in data["items"]:
+            self.add_item(item[0], Item.model_validate(item[1]))
 
-            # Clear the input box after sending
-            self.last_query = message
-            self.last_response = data
-            self.entry_var.set("")
+        # Clear the input box after sending
+        self.last_query = message
+        self.last_response = data
+        self.entry_var.set("")
 
     def add_item(self, id, item):
         """ Adds an item to the chat frame with bubble styling. """
@@ -390,21 +440,25 @@ class MyRentingsItem(customtkinter.CTkFrame):
 
     def handover(self):
         code = self.code_var.get()
+        run_async(self, self.return_item(code), self.handover_done)
 
-        status = sync_query(
-            destination=self.owner, message=HandOverEnd(item=self.item, code=code))
+    async def return_item(self, code):
+        client = get_query_client()
+
+        status = await client.query(
+            self.owner, HandOverEnd(item=self.item, code=code))
 
         if not status:
             print("Unable to connect to agent")
-            return
+            return False
 
         if status["status"]:
-            status = sync_query(
-                destination=self.agent, message=HandOverEndConfirm(item=self.item))
+            status = await client.query(
+                self.agent, HandOverEndConfirm(item=self.item, owner=self.owner))
 
             if not status:
                 print("Error: Unable to handover item")
-                return
+                return False
 
             if status["status"]:
 
@@ -412,21 +466,17 @@ class MyRentingsItem(customtkinter.CTkFrame):
 
                 print(central_agent_data)
 
-                sync_query(
-                    destination=central_agent_data.agent_address, message=PaymentCancel(id=self.payment_id)
+                _, status = await asyncio.gather(
+                    client.query(central_agent_data.agent_address, PaymentCancel(id=self.payment_id)),
+                    client.query(self.location, AddRequest(item=self.item, agent_address=self.owner))
                 )
 
-                status = sync_query(self.location, AddRequest(item=self.item, agent_address=self.owner))
-
                 if not status:
                     print("Error: Unable to handover item")
-                    return
+                    return False
                 
                 if status["status"]:
-
-                    print("Item handed over successfully")
-                    self.grid_forget()
-                    self.reload()
+                    return True
 
                 else:
                     print("Error: Unable to handover item")
@@ -440,7 +490,13 @@ class MyRentingsItem(customtkinter.CTkFrame):
             print("Error: Unable to handover item")
             print(status["content"])
 
-            return
+        return False
+
+    def handover_done(self, success):
+        if success:
+            print("Item handed over successfully")
+            self.grid_forget()
+            self.reload()
 
 
 class MyRenting(customtkinter.CTkFrame):
@@ -525,22 +581,28 @@ class ItemCard(customtkinter.CTkFrame):
         request = DeleteRequest(
             name=self.item.name, category=self.item.category, agent_address=self.agent)
 
-        status = sync_query(
-            destination=self.agent_location, message=request)
+        async def delete():
+            client = get_query_client()
+            city_status = await client.query(self.agent_location, request)
+            if not city_status or not city_status["status"]:
+                return city_status, None
+            return city_status, await client.query(self.agent, request)
 
-        if not status:
+        run_async(self, delete(), self.delete_done)
+
+    def delete_done(self, result):
+        if not result or not result[0]:
             self.message.configure(text="Unable to connect to location")
             print("unable to connect to location")
             return
 
-        if status["status"]:
-            status = sync_query(
-                destination=self.agent, message=request)
+        city_status, status = result
+
+        if city_status["status"]:
 
             if not status:
                 self.message.configure(
                     text="Error: Unable to delete item from agent")
-                print(status["content"])
                 return
 
             if status["status"]:
@@ -557,7 +619,7 @@ class ItemCard(customtkinter.CTkFrame):
         else:
             self.message.configure(
                 text="Error: Unable to delete item from city")
-            print(status["content"])
+            print(city_status["content"])
 
             return
 
@@ -743,51 +805,60 @@ class AddItem(customtkinter.CTkFrame):
         item = Item(name=item_name, price=float(item_price), period=payment_period,
                     image=encoded_image, category=item_category, description=item_description)
 
-        status = sync_query(
-            destination=self.agent_location, message=AddRequest(item=item, agent_address=self.agent_address))
+        run_async(self, self.add_item(item), self.submit_done)
+
+    async def add_item(self, item):
+        client = get_query_client()
+
+        status = await client.query(
+            self.agent_location, AddRequest(item=item, agent_address=self.agent_address))
 
         if not status:
-            self.message.configure(text="Unable to connect to agent")
-            return
+            return "Unable to connect to agent", None
 
         if status["status"]:
-            status = sync_query(
-                destination=self.agent_address, message=item)
+            status = await client.query(self.agent_address, item)
 
             if not status:
-                self.message.configure(
-                    text="Error: Unable to add item to agent")
-                return
+                return "Error: Unable to add item to agent", None
 
             if status["status"]:
-                status = sync_query(
-                    destination=self.agent_address, message=ItemRequest(name=None))
+                status = await client.query(
+                    self.agent_address, ItemRequest(name=None))
 
                 if not status:
-                    self.message.configure(
-                        text="Error: Unable to add item to agent")
-                    return
-
-                if status["status"]:
-                    items = []
-                    for item in status["content"]:
-                        items.append(Item(**item))
-
-                    self.callback(True, items)
-                    self.reload()
+                    return "Error: Unable to add item to agent", None
 
-                else:
-                    self.callback(False, "Unable to fetch new items.")
+                return None, status
 
             else:
-                self.message.configure(
-                    text="Error: Unable to add item to agent")
-                return
+                return "Error: Unable to add item to agent", None
 
         else:
-            self.message.configure(text="Error: Unable to add item to city")
+            return "Error: Unable to add item to city", None
+
+    def submit_done(self, result):
+        if not result:
+            self.message.configure(text="Unable to connect to agent")
+            return
+
+        error, status = result
+
+        if error:
+            self.message.configure(text=error)
             return
 
+        if status["status"]:
+            items = []
+            for item in status["content"]:
+                items.append(Item(**item))
+
+            self.callback(True, items)
+            self.reload()
+
+        else:
+            self.callback(False, "Unable to fetch new items.")
+
 
 class RequestedItemView(customtkinter.CTkFrame):
     def __init__(self, master, item: Item, code, **kwargs):
@@ -957,7 +1028,16 @@ class HandOverItem(customtkinter.CTkFrame):
         
         
         
-        to_wallet = sync_query(destination=self.address, message=WalletRequest(any=None))["content"]
+        self.handover_button.configure(state="disabled")
+        run_async(self, self.confirm_handover(code), self.handover_done)
+
+    async def confirm_handover(self, code):
+        client = get_query_client()
+
+        wallet = await client.query(self.address, WalletRequest(any=None))
+        if not wallet or not wallet["status"]:
+            return None
+        to_wallet = wallet["content"]
         amount = self.item.price
         frequency = self.item.period
 
@@ -966,18 +1046,28 @@ class HandOverItem(customtkinter.CTkFrame):
         payment_request = PaymentRequest(
             from_address=self.id,
             to_address=to_wallet,
+            to_agent=self.address,
             amount=amount,
             frequency=frequency
         )
 
-        payment_response = sync_query(destination=central_agent_data.agent_address, message=payment_request)["content"]
-
-
-        sync_query(
-            destination=self.address, message=RentConfirmRequest(item=self.item, code=code, agent=self.id, payment_id=payment_response))
-        sync_query(
-            destination=self.id, message=handOverConfirm(item=self.item))
+        payment = await client.query(central_agent_data.agent_address, payment_request)
+        if not payment or not payment["status"]:
+            return None
 
+        confirmations = await asyncio.gather(
+            client.query(self.address, RentConfirmRequest(item=self.item, code=code, agent=self.id, payment_id=payment["content"])),
+            client.query(self.id, handOverConfirm(item=self.item))
+        )
+        if not all(status and status["status"] for status in confirmations):
+            return None
+        return True
+
+    def handover_done(self, result):
+        if result is None:
+            print("Hand over failed, please try again")
+            self.handover_button.configure(state="normal")
+            return
         self.grid_forget()
         self.reload()
 
@@ -1083,6 +1173,51 @@ class HandOverView(customtkinter.CTkFrame):
             item_card.grid(row=i, column=0, padx=10, pady=10)
 
 
+class BillingView(customtkinter.CTkFrame):
+    def __init__(self, master, agent_address, **kwargs):
+        super().__init__(master, **kwargs)
+
+        self.agent_address = agent_address
+        self.cursor = None
+        self.rows = 0
+
+        self.view = customtkinter.CTkScrollableFrame(
+            self, height=450, width=760)
+        self.view.grid(row=0, column=0)
+
+        # Pages through the central agent's payment log, newest first
+        self.more_button = customtkinter.CTkButton(
+            self, text="Load more", command=self.load_page)
+        self.more_button.grid(row=1, column=0, padx=10, pady=10)
+
+        self.load_page()
+
+    def load_page(self):
+        self.more_button.configure(state="disabled")
+        central_agent_data = get_agents("central_agent")
+        run_async(self, get_query_client().query(
+            central_agent_data.agent_address,
+            PaymentHistoryRequest(address=self.agent_address, before=self.cursor)), self.show_page)
+
+    def show_page(self, response):
+        if not response or not response["status"]:
+            self.more_button.configure(state="normal")
+            return
+
+        for event in response["content"]["events"]:
+            label = customtkinter.CTkLabel(
+                self.view, text=f"#{event['payment_id']}  {event['type']}  {event['amount']}atestfet  ->  {event['to']}",
+                font=("Arial", 12), anchor="w")
+            label.grid(row=self.rows, column=0, padx=10, pady=2, sticky="w")
+            self.rows += 1
+
+        self.cursor = response["content"]["next"]
+        if self.cursor is None:
+            self.more_button.grid_forget()
+        else:
+            self.more_button.configure(state="normal")
+
+
 class MyTabView(customtkinter.CTkTabview):
     def __init__(self, master, agent_address, agent_location, rents, items, requested, handover, rented, message, reload, **kwargs):
         super().__init__(master, **kwargs)
@@ -1093,6 +1228,7 @@ class MyTabView(customtkinter.CTkTabview):
         self.add("Rented")
         self.add("Requested")
         self.add("Hand Over")
+        self.add("Billing")
 
         self.message = message
 
@@ -1106,6 +1242,7 @@ class MyTabView(customtkinter.CTkTabview):
         self.requested_view = RequestedView(self.tab("Requested"), requested, reload=reload)
         self.handover_view = HandOverView(
             self.tab("Hand Over"), handover, agent_address, reload=reload)
+        self.billing_view = BillingView(self.tab("Billing"), agent_address)
 
         self.chat_view.grid(row=0, column=0)
         self.my_renting.grid(row=0, column=0)
@@ -1113,6 +1250,7 @@ class MyTabView(customtkinter.CTkTabview):
         self.rended_view.grid(row=0, column=0)
         self.requested_view.grid(row=0, column=0)
         self.handover_view.grid(row=0, column=0)
+        self.billing_view.grid(row=0, column=0)
 
 
 class LoginView(customtkinter.CTkFrame):
@@ -1159,9 +1297,10 @@ class LoginView(customtkinter.CTkFrame):
         central_agent_data = get_agents("central_agent")
 
         print(central_agent_data)
-        status = sync_query(
-            destination=central_agent_data.agent_address, message=AgentRequest(id=username))
+        run_async(self, get_query_client().query(
+            central_agent_data.agent_address, AgentRequest(id=username)), self.authenticate_done)
 
+    def authenticate_done(self, status):
         if not status:
             self.message.configure(text="Unable to connect to central agent")
             self.login_button.grid(row=2, column=1, padx=5, pady=10)
@@ -1205,33 +1344,40 @@ class App(customtkinter.CTk):
 
     def load_app(self):
 
-        while True:
-            response = sync_query(
-                destination=self.agent_address, message=DataRequest(data=None))
-            if not response:
-                continue
-            items = []
-            rents = []
-            rented = []
-            requested = []
-            handover = []
+        async def fetch():
+            while True:
+                response = await get_query_client().query(
+                    self.agent_address, DataRequest(data=None))
+                if response:
+                    return response
 
-            for item in response["content"]["items"]:
-                items.append(Item(**item))
+        run_async(self, fetch(), self.show_app)
+
+    def show_app(self, response):
+
+        if not response:
+            return
+
+        items = []
+        rents = []
+        rented = []
+        requested = []
+        handover = []
 
-            for rent in response["content"]["rents"]:
-                rents.append((Item(**rent[0]), rent[1], rent[2]))
+        for item in response["content"]["items"]:
+            items.append(Item(**item))
 
-            for rent in response["content"]["rented"]:
-                rented.append((Item(**rent[0]), rent[1]))
+        for rent in response["content"]["rents"]:
+            rents.append((Item(**rent[0]), rent[1], rent[2]))
 
-            for rent in response["content"]["requested"]:
-                requested.append((Item(**rent[0]), rent[1]))
+        for rent in response["content"]["rented"]:
+            rented.append((Item(**rent[0]), rent[1]))
 
-            for rent in response["content"]["handover"]:
-                handover.append((Item(**rent[0]), rent[1]))
+        for rent in response["content"]["requested"]:
+            requested.append((Item(**rent[0]), rent[1]))
 
-            break
+        for rent in response["content"]["handover"]:
+            handover.append((Item(**rent[0]), rent[1]))
 
         # Message label
         self.message = customtkinter.CTkLabel(
@@ -2,13 +2,27 @@ from uagents import Agent, Context, Protocol  # type: ignore
 from utils import create_agent, AgentData, get_agents
 from models import *
 from rich.prompt import Prompt
-from random import choice
-from string import ascii_letters, digits
 from typing import Dict
+from ledger import get_ledger, send_tokens_batch
+from ids import CodePool
+from rentals import COLLECTIONS, entry_owner, get_rentals
+import sys
 
 
-wallet = None
-wallet_address = None
+# Wallets per user agent address
+wallets: Dict[str, Any] = {}
+# Outstanding rent ("rent") and return ("return") codes per user agent address
+code_pools: Dict[str, CodePool] = {}
+
+
+def get_code_pool(context: Context) -> CodePool:
+    if context.agent.address not in code_pools:
+        rentals = get_rentals(context)
+        pool = CodePool()
+        pool.load("rent", (entry[1] for entry in rentals.values("requested")))
+        pool.load("return", (entry[1] for entry in rentals.values("rented")))
+        code_pools[context.agent.address] = pool
+    return code_pools[context.agent.address]
 
 user_registration_protocol = Protocol(
     name="user_registration_protocol", version="1.0")
@@ -20,9 +34,12 @@ requested_protocol = Protocol(
 
 @requested_protocol.on_query(model=RequestedItem, replies={Response})
 async def add_item(context: Context, sender: str, item: RequestedItem):
-    requested = context.storage.get("requested")
-    requested.append((item.item.model_dump(), ''.join(choice(digits) for _ in range(4))))
-    context.storage.set("requested", requested)
+    rentals = get_rentals(context)
+    with context.storage.batch():
+        previous = rentals.remove("requested", item.item.name, item.owner)
+        if previous:
+            get_code_pool(context).release("rent", previous[1])
+        rentals.add("requested", (item.item.model_dump(), get_code_pool(context).allocate("rent"), item.owner))
     await context.send(destination=sender, message=Response(status=True, content="Item added"))
 
 
@@ -32,31 +49,42 @@ rent_protocol = Protocol(
 
 @rent_protocol.on_query(model=RentConfirmRequest, replies={Response})
 async def get_rdents(context: Context, sender: str, request: RentConfirmRequest):
-    requested = context.storage.get("requested")
-    rents = context.storage.get("rents")
-    
-    for item in requested:
-        if item[0]["name"] == request.item.name:
-            if item[1] != request.code:
-                await context.send(destination=sender, message=Response(status=False, content="Invalid code"))
-                return
-            requested.remove(item)
-            rents.append((item[0], request.agent, request.payment_id))
-            context.storage.set("requested", requested)
-            context.storage.set("rents", rents)
-            await context.send(destination=sender, message=Response(status=True, content="Item rented"))
-            return
-        
-    await context.send(destination=sender, message=Response(status=False, content="Item not found"))
+    rentals = get_rentals(context)
+    # Redeem the code and move the item under one lock, so a code is only ever redeemed once
+    with context.storage.batch():
+        item = rentals.find("requested", request.code)
+        redeemed = bool(item) and item[0]["name"] == request.item.name \
+            and entry_owner("requested", item) in (None, request.agent)
+        if redeemed:
+            rentals.move("requested", "rents", request.item.name,
+                         lambda item: (item[0], request.agent, request.payment_id),
+                         owner=entry_owner("requested", item))
+            get_code_pool(context).release("rent", request.code)
+
+    if redeemed:
+        await context.send(destination=sender, message=Response(status=True, content="Item rented"))
+    elif rentals.get("requested", request.item.name, request.agent):
+        await context.send(destination=sender, message=Response(status=False, content="Invalid code"))
+    else:
+        await context.send(destination=sender, message=Response(status=False, content="Item not found"))
 
 payment_protocol = Protocol(
     name="payment_protocol", version="1.0")
 
 @payment_protocol.on_query(model=TransactionRequest, replies={Response})
 async def get_payment(context: Context, sender: str, request: TransactionRequest):
-    global wallet
-    transaction = context.ledger.send_tokens(
-        request.to_address, request.amount, "atestfet", wallet
+    transaction = get_ledger(context).send_tokens(
+        request.to_address, request.amount, "atestfet", wallets[context.agent.address]
+    )
+    await context.send(destination=sender, message=Response(status=True, content=transaction.tx_hash))
+
+@payment_protocol.on_query(model=BatchTransactionRequest, replies={Response})
+async def get_batch_payment(context: Context, sender: str, request: BatchTransactionRequest):
+    transaction = send_tokens_batch(
+        get_ledger(context),
+        [(transfer.to_address, transfer.amount) for transfer in request.transactions],
+        "atestfet",
+        wallets[context.agent.address]
     )
     await context.send(destination=sender, message=Response(status=True, content=transaction.tx_hash))
 
@@ -67,60 +95,49 @@ handover_protocol = Protocol(
 
 @handover_protocol.on_query(model=HandOverRequest, replies={Response})
 async def get_rents(context: Context, sender: str, request: HandOverRequest):
-    handover = context.storage.get("handover")
-    handover.append((request.item.model_dump(), request.agent))
-    context.storage.set("handover", handover)
-    items = context.storage.get("items")
-    items.remove(request.item.model_dump())
-    context.storage.set("items", items)
+    rentals = get_rentals(context)
+    if not rentals.move("items", "handover", request.item.name, lambda item: (item, request.agent)):
+        rentals.add("handover", (request.item.model_dump(), request.agent))
     await context.send(destination=sender, message=Response(status=True, content="Item rented"))
 
 
 @handover_protocol.on_query(model=handOverConfirm, replies={Response})
 async def get_ren__ts(context: Context, sender: str, request: handOverConfirm):
-    handover = context.storage.get("handover")
-    rented = context.storage.get("rented")
-    
-    for item in handover:
-        if item[0]["name"] == request.item.name:
-            handover.remove(item)
-            rented.append((item[0], "".join(choice(digits) for _ in range(4))))
-            context.storage.set("handover", handover)
-            context.storage.set("rented", rented)
-            await context.send(destination=sender, message=Response(status=True, content="Item rented"))
-            return
-        
+    rentals = get_rentals(context)
+    with context.storage.batch():
+        moved = rentals.get("handover", request.item.name) and rentals.move(
+            "handover", "rented", request.item.name, lambda item: (item[0], get_code_pool(context).allocate("return")))
+    if moved:
+        await context.send(destination=sender, message=Response(status=True, content="Item rented"))
+        return
+
     await context.send(destination=sender, message=Response(status=False, content="Item not found"))
 
 
 @handover_protocol.on_query(model=HandOverEndConfirm, replies={Response})
 async def get______rents(context: Context, sender: str, request: HandOverEndConfirm):
-    rents = context.storage.get("rents")
-    for item in rents:
-        if item[0]["name"] == request.item.name:
-            rents.remove(item)
-            context.storage.set("rents", rents)
-            await context.send(destination=sender, message=Response(status=True, content="Item returned"))
-            return
+    if get_rentals(context).remove("rents", request.item.name, request.owner):
+        await context.send(destination=sender, message=Response(status=True, content="Item returned"))
+        return
     await context.send(destination=sender, message=Response(status=False, content="Item not found"))
 
 
 @handover_protocol.on_query(model=HandOverEnd, replies={Response})
 async def ge___t_rentss(context: Context, sender: str, request: HandOverEnd):
-    rented = context.storage.get("rented")
-    for item in rented:
-        if item[0]["name"] == request.item.name:
-            if item[1] != request.code:
-                await context.send(destination=sender, message=Response(status=False, content="Invalid code"))
-                return
-            rented.remove(item)
-            context.storage.set("rented", rented)
-            items = context.storage.get("items")
-            items.append(item[0])
-            context.storage.set("items", items)
-            await context.send(destination=sender, message=Response(status=True, content="Item returned"))
-            return
-    await context.send(destination=sender, message=Response(status=False, content="Item not found"))
+    rentals = get_rentals(context)
+    with context.storage.batch():
+        item = rentals.find("rented", request.code)
+        redeemed = bool(item) and item[0]["name"] == request.item.name
+        if redeemed:
+            rentals.move("rented", "items", request.item.name, lambda item: item[0])
+            get_code_pool(context).release("return", request.code)
+
+    if redeemed:
+        await context.send(destination=sender, message=Response(status=True, content="Item returned"))
+    elif rentals.get("rented", request.item.name):
+        await context.send(destination=sender, message=Response(status=False, content="Invalid code"))
+    else:
+        await context.send(destination=sender, message=Response(status=False, content="Item not found"))
 
 
 
@@ -165,10 +182,8 @@ async def register_user(context: Context, sender: str, request: LocationAddress)
 @user_registration_protocol.on_message(model=UserID, replies={UserLocationLink})
 async def activate_user(context: Context, sender: str, request: UserID):
     context.logger.info(f"User activated")
-    userinfo: User = User.model_validate(context.storage.get("userinfo"))
-    userinfo.id = request.id
-    context.storage.set("userinfo", userinfo.model_dump())
-    context.logger.info(f"{userinfo.name} activated with ID: {request.id}")
+    _, userinfo = context.storage.update("userinfo", [], lambda info: {**info, "id": request.id})
+    context.logger.info(f"{userinfo['name']} activated with ID: {request.id}")
     central_agent_data: AgentData = get_agents("central_agent")
     await context.send(destination=central_agent_data.agent_address, message=UserLocationLink(id=request.id, location=context.storage.get("location")))
 
@@ -187,21 +202,15 @@ item_management_protocol = Protocol(
 
 @item_management_protocol.on_query(model=Item, replies={Response})
 async def add_i_tem(context: Context, sender: str, item: Item):
-    items = context.storage.get("items")
-    items.append(item.model_dump())
-    context.storage.set("items", items)
+    get_rentals(context).add("items", item.model_dump())
     await context.send(destination=sender, message=Response(status=True, content="Item added"))
 
 
 @item_management_protocol.on_query(model=DeleteRequest, replies={Response})
 async def delete_item(context: Context, sender: str, request: DeleteRequest):
-    items = context.storage.get("items")
-    for item in items:
-        if item["name"] == request.name:
-            items.remove(item)
-            context.storage.set("items", items)
-            await context.send(destination=sender, message=Response(status=True, content="Item deleted"))
-            return
+    if get_rentals(context).remove("items", request.name):
+        await context.send(destination=sender, message=Response(status=True, content="Item deleted"))
+        return
     await context.send(destination=sender, message=Response(status=False, content="Item not found"))
 
 
@@ -211,54 +220,51 @@ user_application_link_protocol = Protocol(
 
 @user_application_link_protocol.on_query(model=WalletRequest, replies={Response})
 async def get_wallet(context: Context, sender: str, request: WalletRequest):
-    global wallet_address
+    wallet_address = str(wallets[context.agent.address].address())
     await context.send(destination=sender, message=Response(status=True, content=wallet_address))
 
 
 @user_application_link_protocol.on_query(model=ItemRequest, replies={Response})
 async def get_items(context: Context, sender: str, request: ItemRequest):
-    items = context.storage.get("items")
+    rentals = get_rentals(context)
     userinfo = context.storage.get("userinfo")
 
     if request.name:
-        for item in items:
-            if item["name"] == request.name:
-                await context.send(destination=sender, message=Response(status=True, content=(item, userinfo)))
-                return
+        item = rentals.get("items", request.name)
+        if item:
+            await context.send(destination=sender, message=Response(status=True, content=(item, userinfo)))
+            return
         await context.send(destination=sender, message=Response(status=False, content="Item not found"))
     else:
-        await context.send(destination=sender, message=Response(status=True, content=items))
+        await context.send(destination=sender, message=Response(status=True, content=rentals.values("items")))
 
 
 @user_application_link_protocol.on_query(model=DataRequest, replies={Response})
 async def ge__t_rents(context: Context, sender: str, request: DataRequest):
-    rents = context.storage.get("rents")
-    items = context.storage.get("items")
-    rented = context.storage.get("rented")
-    handover = context.storage.get("handover")
-    requested = context.storage.get("requested")
-    
-    response = {
-        "rents": rents,
-        "items": items,
-        "rented": rented,
-        "handover": handover,
-        "requested": requested
-    }
+    rentals = get_rentals(context)
+    response = {collection: rentals.values(collection) for collection in COLLECTIONS}
 
     await context.send(destination=sender, message=Response(status=True, content=response))
 
 
 
-def create_user_agent(code: str, central_agent_address: str) -> Agent:
+def create_user_agent(
+    code: str,
+    central_agent_address: str,
+    port: Optional[int] = None,
+    userinfo: Optional[Dict[str, Any]] = None
+) -> Agent:
 
     async def register(context: Context) -> None:
+        if userinfo and not context.storage.has("userinfo"):
+            context.storage.set("userinfo", User(id=None, **userinfo).model_dump())
+
         if context.storage.has("userinfo"):
-            userinfo: User = User.model_validate(
+            info: User = User.model_validate(
                 context.storage.get("userinfo"))
             # context.storage.set("wallet", )
-            context.logger.info(f"Connecting to location: {userinfo.address.city}...")
-            await context.send(destination=central_agent_address, message=LocationRequest(location=userinfo.address.city))
+            context.logger.info(f"Connecting to location: {info.address.city}...")
+            await context.send(destination=central_agent_address, message=LocationRequest(location=info.address.city))
         else:
             context.logger.info("User information not found")
             await context.send(destination=central_agent_address, message=LocationRequest(location=None))
@@ -270,15 +276,13 @@ def create_user_agent(code: str, central_agent_address: str) -> Agent:
     city_agent: Agent = create_agent(
         f"{code}",
         secret=f"{code}_secret",
-        storage_initials={"items": [], "rents": [], "requested": [], "rented": [], "handover": []},
+        port=port,
         protocols=[user_registration_protocol, user_application_link_protocol, item_management_protocol, requested_protocol, rent_protocol, handover_protocol, payment_protocol],
         custom_startup_function=register,
         custom_shutdown_function=unregister
     )
 
-    global wallet_address, wallet
-    wallet = city_agent.wallet
-    wallet_address = str(city_agent.wallet.address())
+    wallets[city_agent.address] = city_agent.wallet
 
     return city_agent
 
@@ -291,7 +295,7 @@ if __name__ == "__main__":
         exit(1)
 
     # "".join(choice(ascii_letters + digits) for _ in range(32))
-    code = input("Enter the user code: ")
+    code = sys.argv[1] if len(sys.argv) > 1 else input("Enter the user code: ")
 
     city_agent = create_user_agent(
         code, central_agent_address=central_agent_data.agent_address)
@@ -1,23 +1,31 @@
-from json import load, dump
 from dotenv import load_dotenv
-from os import getenv, path, makedirs
+from env import env_flag
+from os import getenv
+from time import time
 from pydantic import BaseModel, Field
-from typing_extensions import Optional, Dict, Any, Tuple, List, Callable
+from typing_extensions import Optional, Dict, Any, Tuple, List, Callable, Coroutine
 from random import choice
 from string import ascii_letters, digits
 from functools import wraps
 from uagents import Agent, Context, Bureau, Protocol  # type: ignore
 from uagents.setup import fund_agent_if_low  # type: ignore
-from uagents.envelope import Envelope  # type: ignore
-from uagents.query import query  # type: ignore
+from transport import transport, install_transport, local_bus
+from resolver import local_resolver
+from registry import get_registry, free_port, port_in_use
+from storage import create_storage, WriteBehindStorage
+from ledger import get_local_ledger
 import asyncio
+from concurrent.futures import Future
+from threading import Thread, Lock
 import base64
 from io import BytesIO
 from PIL import Image, ImageTk
-import json
 
 load_dotenv()
 
+FAST_BOOT = env_flag("FAST_BOOT")
+FUNDING_TTL = float(getenv("FUNDING_TTL", 24 * 60 * 60))
+
 
 def encode_image(image: bytes) -> str:
     return base64.b64encode(image).decode('utf-8')
@@ -31,85 +39,57 @@ def decode_image(image: str) -> Any:
     return photo
 
 
+class QueryClient:
+    """Runs agent queries on one long-lived event loop in a background thread.
+
+    Callers outside the loop get a `concurrent.futures.Future` back, so the UI
+    can keep its own main loop running while any number of queries are in flight.
+    """
+
+    def __init__(self, timeout: float = 240.0) -> None:
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(
+            target=self.loop.run_forever, name="query-client", daemon=True)
+        self.thread.start()
+
+    async def query(self, destination: str, message: Any, timeout: Optional[float] = None) -> Any:
+        return await transport.query_json(destination, message, timeout=timeout or self.timeout)
+
+    def run(self, coroutine: Coroutine) -> Future:
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def submit(self, destination: str, message: Any, timeout: Optional[float] = None) -> Future:
+        return self.run(self.query(destination, message, timeout))
+
+    def close(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+_query_client: Optional[QueryClient] = None
+_query_client_lock = Lock()
+
+
+def get_query_client() -> QueryClient:
+    global _query_client
+    with _query_client_lock:
+        if _query_client is None:
+            _query_client = QueryClient()
+    return _query_client
+
+
 def sync_query(destination: str, message: Any) -> Any:
-    async def await_query(address: str, message: Any) -> Any:
-        return await query(destination=address, message=message, timeout=240.0)
-    loop = asyncio.new_event_loop()
-    old_loop = asyncio.get_event_loop()
-    asyncio.set_event_loop(loop)
-    data = asyncio.run(await_query(destination, message))
-    asyncio.set_event_loop(old_loop)
-    if not isinstance(data, Envelope):
-        return None
-    return json.loads(data.decode_payload())
-
-
-def ensure_files(func):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-
-        file_path = getenv("AGENT_FILE_PATH")
-
-        if not file_path:
-            raise ValueError(
-                "`AGENT_FILE_PATH` is not set in environment variables")
-
-        if path.dirname(file_path) and not path.exists(path.dirname(file_path)):
-            makedirs(path.dirname(file_path))
-
-        if not path.exists(file_path):
-            with open(file_path, 'w') as file:
-                dump({
-                    "config": {
-                        "start_port": 8000,
-                        "active_ports": []
-                    },
-                    "agents": {},
-                    "items": ["wearable", "transport", "electronic", "furniture"]
-                }, file, indent=4)
-                file.truncate()
-
-        if not path.isfile(file_path):
-            raise ValueError(f"{file_path} is not a file")
-
-        with open(file_path, 'r+') as file:
-            try:
-                load(file)
-            except Exception as e:
-                file.seek(0)
-                dump({
-                    "config": {
-                        "start_port": 8000,
-                        "active_ports": []
-                    },
-                    "agents": {},
-                    "items": ["wearable", "transport", "electronic", "furniture"]
-                }, file, indent=4)
-                file.truncate()
-
-        return func(file_path, *args, **kwargs)
-    return wrapper
-
-
-@ensure_files
-def get_port(file_path: str) -> int:
-    with open(file_path, 'r+') as file:
-        data = load(file)
-        port = data["config"]["start_port"]
-        while not port or port in data["config"]["active_ports"]:
-            port += 1
-        data["config"]["active_ports"].append(port)
-        file.seek(0)
-        dump(data, file, indent=4)
-        file.truncate()
-    return port
-
-
-@ensure_files
-def get_items(file_path: str) -> List[str]:
-    with open(file_path, 'r') as file:
-        data = load(file)
-        return data["items"]
+    return get_query_client().submit(destination, message).result()
+
+
+def get_port() -> int:
+    return get_registry().allocate_port()
+
+
+def get_items() -> List[str]:
+    return get_registry().get_items()
 
 
 class AgentData(BaseModel):
@@ -121,45 +101,85 @@ class AgentData(BaseModel):
     wallet_address: Optional[str] = None
 
 
-@ensure_files
+def fund_agent(wallet_address: str) -> None:
+    """Tops the wallet up from the faucet unless it was already funded within `FUNDING_TTL` seconds."""
+    funded = get_registry().read().get("funding", {}).get(wallet_address, 0)
+    if time() - funded < FUNDING_TTL:
+        return
+    fund_agent_if_low(wallet_address)
+    with get_registry().update() as data:
+        data.setdefault("funding", {})[wallet_address] = time()
+
+
 def create_agent(
-    file_path: str,
     name: str,
     secret: Optional[str] = None,
+    port: Optional[int] = None,
     storage_initials: Optional[Dict[str, Any]] = None,
     protocols: Optional[List[Protocol]] = None,
     custom_startup_function: Optional[Callable] = None,
-    custom_shutdown_function: Optional[Callable] = None
+    custom_shutdown_function: Optional[Callable] = None,
+    fast_boot: Optional[bool] = None
 ) -> Agent:
 
-    print("Initializing Agent...")
+    if fast_boot is None:
+        fast_boot = FAST_BOOT
+    log: Callable = (lambda *args: None) if fast_boot else print
+
+    log("Initializing Agent...")
 
-    print("Creating AgentData...")
-    agent_data = AgentData(name=name)
-    print("AgentData created.")
+    log("Creating AgentData...")
+    agent_data = AgentData(name=name, port=port) if port else AgentData(name=name)
+    log("AgentData created.")
 
-    print("Setting Agent secret...")
+    log("Setting Agent secret...")
     if secret:
         agent_data.secret = secret
-    print("Agent secret set.")
+    log("Agent secret set.")
 
-    print("Creating Agent...")
+    install_transport()
+
+    log("Creating Agent...")
     agent: Agent = Agent(
         name=agent_data.name,
         seed=agent_data.secret,
         port=agent_data.port,
-        endpoint=[f"http://127.0.0.1:{agent_data.port}/submit"]
+        endpoint=[f"http://127.0.0.1:{agent_data.port}/submit"],
+        resolve=local_resolver
     )
-    print("Agent created.")
-
-    print("Funding Agent...")
-    fund_agent_if_low(agent.wallet.address())
-    print("Agent funded.")
+    # Swap in the configured storage engine before any context captures the default store
+    agent._storage = create_storage(agent.address[0:16])
+
+    if isinstance(agent._storage, WriteBehindStorage):
+        @agent.on_interval(period=agent._storage.max_delay / 2)
+        async def flush_write_behind(context: Context) -> None:
+            if agent._storage.due():
+                agent._storage.flush()
+    log("Agent created.")
+
+    if get_local_ledger() is not None:
+        # Local ledgers start every wallet with a balance; the testnet faucet may not even be reachable
+        log("Local ledger in use, skipping testnet funding.")
+    elif fast_boot:
+        @agent.on_event("startup")
+        async def fund_in_background(context: Context) -> None:
+            get_registry().flush()
+
+            def funded(future: asyncio.Future) -> None:
+                if future.exception():
+                    context.logger.warning(f"Background funding failed: {future.exception()}")
+
+            asyncio.get_running_loop().run_in_executor(
+                None, fund_agent, str(agent.wallet.address())).add_done_callback(funded)
+    else:
+        log("Funding Agent...")
+        fund_agent(str(agent.wallet.address()))
+        log("Agent funded.")
 
-    print("Setting AgentData addresses...")
+    log("Setting AgentData addresses...")
     agent_data.agent_address = agent.address
     agent_data.wallet_address = str(agent.wallet.address())
-    print("AgentData addresses set.")
+    log("AgentData addresses set.")
 
     def startup_wrapper(custom_startup_function: Optional[Callable]) -> Callable:
         if not custom_startup_function:
@@ -196,8 +216,12 @@ def create_agent(
                 context.logger.info("Setting storage initials...")
                 if storage_initials:
                     for key, value in storage_initials.items():
-                        context.logger.info(f"Setting {key} to {value}")
-                        context.storage.set(key, value)
+                        if context.storage.has(key):
+                            context.logger.info(
+                                f"Key {key} already exists. Skipping...")
+                        else:
+                            context.logger.info(f"Setting {key} to {value}")
+                            context.storage.set(key, value)
                 context.logger.info("Storage initials set.")
 
                 context.logger.info("Executing custom startup function...")
@@ -208,6 +232,12 @@ def create_agent(
 
             return wrapped_startup
 
+    def flush_storage(context: Context) -> None:
+        if isinstance(agent._storage, WriteBehindStorage):
+            context.logger.info("Flushing storage...")
+            agent._storage.close()
+            context.logger.info("Storage flushed.")
+
     def shutdown_wrapper(custom_shutdown_function: Optional[Callable]) -> Callable:
         if not custom_shutdown_function:
             async def unregister(context: Context) -> None:
@@ -217,6 +247,8 @@ def create_agent(
                 remove_agent(name)
                 context.logger.info("Agent removed from active ports.")
 
+                flush_storage(context)
+
                 context.logger.info("Default shutdown function completed.")
             return unregister
         else:
@@ -232,54 +264,62 @@ def create_agent(
                 remove_agent(name)
                 context.logger.info("Agent removed from active ports.")
 
+                flush_storage(context)
+
                 context.logger.info("Custom shutdown function completed.")
             return wrapped_shutdown
 
-    print("Setting startup and shutdown functions...")
+    log("Setting startup and shutdown functions...")
     agent.on_event("startup")(startup_wrapper(custom_startup_function))
     agent.on_event("shutdown")(shutdown_wrapper(custom_shutdown_function))
-    print("Startup and shutdown functions set.")
+    log("Startup and shutdown functions set.")
 
     if protocols:
-        print("Including protocols...")
+        log("Including protocols...")
         for protocol in protocols:
-            print(f"Including protocol {protocol.name}")
+            log(f"Including protocol {protocol.name}")
             agent.include(protocol)
-        print("Protocols included.")
+        log("Protocols included.")
     else:
-        print("No protocols to include.")
+        log("No protocols to include.")
+
+    local_bus.register(agent)
 
-    print("Agent initialization completed.")
+    log("Agent initialization completed.")
 
-    print("Saving AgentData...")
-    with open(file_path, 'r+') as file:
-        data = load(file)
+    def save(data: Dict[str, Any]) -> None:
+        previous = data["agents"].pop(name, None)
+        if previous and previous["port"] != agent_data.port and not port_in_use(previous["port"]):
+            release_agent_port(data, previous["port"])
         data["agents"][name] = agent_data.model_dump()
-        file.seek(0)
-        dump(data, file, indent=4)
-        file.truncate()
-    print("AgentData saved.")
+
+    log("Saving AgentData...")
+    if fast_boot:
+        get_registry().defer(save)
+    else:
+        with get_registry().update() as data:
+            save(data)
+    log("AgentData saved.")
 
     return agent
 
 
-@ensure_files
-def remove_agent(file_path: str, name: str) -> None:
-    with open(file_path, 'r+') as file:
-        data = load(file)
+def release_agent_port(data: Dict[str, Any], port: int) -> None:
+    # Agents hosted in one Bureau share its port; free it with the last of them
+    if not any(agent["port"] == port for agent in data["agents"].values()):
+        free_port(data["config"], port)
+
+
+def remove_agent(name: str) -> None:
+    with get_registry().update() as data:
         if name not in data["agents"].keys():
             raise ValueError(f"No agent named {name}")
-        data["config"]["active_ports"].remove(data["agents"][name]["port"])
-        del data["agents"][name]
-        file.seek(0)
-        dump(data, file, indent=4)
-        file.truncate()
-
-
-@ensure_files
-def get_agents(file_path: str, name: str) -> AgentData:
-    with open(file_path, 'r') as file:
-        data = load(file)
-        if name in data["agents"].keys():
-            return AgentData.model_validate(data["agents"][name])
+        port = data["agents"].pop(name)["port"]
+        release_agent_port(data, port)
+
+
+def get_agents(name: str) -> AgentData:
+    agent = get_registry().get_agent(name)
+    if agent:
+        return AgentData.model_validate(agent)
     raise ValueError(f"No agent named {name}")